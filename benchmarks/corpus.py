@@ -0,0 +1,118 @@
+import os
+import random
+import struct
+import zlib
+from typing import Iterator, List
+
+
+class SyntheticCorpusGenerator:
+    """
+    Generates news_content rows shaped like the exported Joomla articles: paragraphs of styled text, galleries of
+    '<img>' tags wrapped into lightbox links, YouTube links and '{youtube}' tags, 'image_intro' in view_data, and
+    image paths shared between the articles and repeated inside one article. The same seed gives the same corpus.
+    """
+    IMAGES_DIR = 'images/novosti'
+    SITE_URL = 'http://chasha.by/'
+
+    PARAGRAPH_HTML = ('<p><span style="font-family: arial, helvetica, sans-serif; font-size: small; color: #888888;">'
+                      '<span lang="ru-RU">{text}</span></span>\n</p>\n')
+    IMAGE_HTML = ('<center><a data-lightbox="group:mygroup1;transitionIn:elastic;transitionOut:elastic;"\n'
+                  '\t\thref="{path}"><img class="img_border" src="{path}" border="0" width="500px" /></a>\n'
+                  '</center>\n')
+    YOUTUBE_LINK_HTML = ('<center><a data-lightbox="group:mygroup1;transitionIn:elastic;transitionOut:elastic;" '
+                         'href="https://youtu.be/{code}" border="0" width="500px" /></a>\n</center>\n')
+    YOUTUBE_TAG_HTML = '<p>{{youtube}}{code}{{/youtube}}</p>\n'
+
+    WORDS = ('tournament', 'cadet', 'school', 'diocese', 'academy', 'republic', 'team', 'participants', 'winners',
+             'gratitude', 'command', 'church', 'sports', 'youth', 'lifestyle', 'education', 'patriotism', 'event')
+
+    def __init__(self, rows_count: int, images_count: int = None, max_images_per_news: int = 12,
+                 paragraphs_per_news: int = 6, duplicated_image_ratio: float = 0.3, youtube_ratio: float = 0.2,
+                 image_size: int = 64, first_news_content_id: int = 1, seed: int = 0):
+        self.rows_count = rows_count
+        self.images_count = images_count or max(rows_count * max_images_per_news // 4, 1)
+        self.max_images_per_news = max_images_per_news
+        self.paragraphs_per_news = paragraphs_per_news
+        self.duplicated_image_ratio = duplicated_image_ratio
+        self.youtube_ratio = youtube_ratio
+        self.image_size = image_size
+        self.first_news_content_id = first_news_content_id
+        self.seed = seed
+
+    @property
+    def image_paths(self) -> List[str]:
+        return [f'{self.IMAGES_DIR}/gallery_{image_index // 20}/photo_{image_index}.png'
+                for image_index in range(self.images_count)]
+
+    def generate_news_contents(self) -> Iterator[dict]:
+        randomizer = random.Random(self.seed)
+        image_paths = self.image_paths
+
+        for row_index in range(self.rows_count):
+            news_image_paths = randomizer.sample(image_paths, randomizer.randint(0, min(self.max_images_per_news,
+                                                                                        len(image_paths))))
+            if news_image_paths and randomizer.random() < self.duplicated_image_ratio:
+                news_image_paths += news_image_paths[:randomizer.randint(1, len(news_image_paths))]
+
+            yield {
+                'news_content_id': self.first_news_content_id + row_index,
+                'title': self._generate_sentence(randomizer, 8).capitalize(),
+                'text': self._generate_html(randomizer, news_image_paths),
+                'created_by_id': 1,
+                'updated_by_id': 1,
+                'view_data': self._generate_view_data(randomizer, image_paths),
+            }
+
+    def _generate_html(self, randomizer, news_image_paths) -> str:
+        html = ''.join(self.PARAGRAPH_HTML.format(text=self._generate_sentence(randomizer, 40))
+                       for _ in range(self.paragraphs_per_news))
+        html += ''.join(self.IMAGE_HTML.format(path=image_path) for image_path in news_image_paths)
+
+        if randomizer.random() < self.youtube_ratio:
+            code = ''.join(randomizer.choices('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-', k=11))
+            html += self.YOUTUBE_LINK_HTML.format(code=code) + self.YOUTUBE_TAG_HTML.format(code=code)
+
+        return html
+
+    def _generate_view_data(self, randomizer, image_paths) -> dict:
+        image_intro = f'{self.SITE_URL}{randomizer.choice(image_paths)}' if image_paths else ''
+        return {
+            'image_intro': image_intro,
+            'float_intro': '',
+            'image_intro_alt': '',
+            'image_intro_caption': '',
+            'image_fulltext': '',
+            'float_fulltext': '',
+            'image_fulltext_alt': '',
+            'image_fulltext_caption': '',
+        }
+
+    def _generate_sentence(self, randomizer, words_count) -> str:
+        return ' '.join(randomizer.choices(self.WORDS, k=words_count)) + '.'
+
+    def write_images(self, root_path):
+        """
+        Writes every image of the corpus under root_path (the same relative paths as in the HTML).
+        Each image is a distinct PNG of random pixels.
+        """
+        randomizer = random.Random(self.seed)
+
+        for image_path in self.image_paths:
+            file_path = os.path.join(root_path, *image_path.split('/'))
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+            with open(file_path, 'wb') as image_file:
+                image_file.write(self._generate_png(randomizer))
+
+    def _generate_png(self, randomizer) -> bytes:
+        width = height = self.image_size
+        raw_rows = b''.join(b'\x00' + randomizer.randbytes(width * 3) for _ in range(height))
+
+        def chunk(chunk_type, data):
+            return (struct.pack('>I', len(data)) + chunk_type + data +
+                    struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+        return (b'\x89PNG\r\n\x1a\n' +
+                chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+                chunk(b'IDAT', zlib.compress(raw_rows)) +
+                chunk(b'IEND', b''))
@@ -0,0 +1,238 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+import sqlalchemy
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+
+from benchmarks.corpus import SyntheticCorpusGenerator
+from db import models
+from db.engine import create_db_engine
+from db.models import mapper_registry
+from db.sessions import DBSessionManager
+from processor import DbDataModifier, AssetsIndex
+from services.file_uploader import FileUploader, FileUploadProcessor, LocalStorageBackend
+from services.metrics import MigrationMetrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimer:
+    """
+    Accumulates the time spent in every stage. The stages may be nested; a stage is charged only with its own
+    time, the time of the nested stages is excluded (e.g. the uploads made while resolving assets).
+    Every thread has its own stack of the started stages; the totals are shared.
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _stack(self) -> list:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def start(self, stage):
+        self._stack.append([stage, time.perf_counter(), 0.0])
+
+    def stop(self):
+        stage, started_at, nested_seconds = self._stack.pop()
+        duration = time.perf_counter() - started_at
+        if self._stack:
+            self._stack[-1][2] += duration
+
+        self.add(stage, duration - nested_seconds)
+
+    def add(self, stage, seconds, calls=1):
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + calls
+
+    @contextmanager
+    def measure(self, stage):
+        self.start(stage)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def wrap(self, obj, attribute_name, stage):
+        method = getattr(obj, attribute_name)
+
+        @wraps(method)
+        def timed_method(*args, **kwargs):
+            with self.measure(stage):
+                return method(*args, **kwargs)
+
+        setattr(obj, attribute_name, timed_method)
+        return method
+
+    def to_dict(self) -> dict:
+        return {stage: {'seconds': round(seconds, 6), 'calls': self.calls[stage]}
+                for stage, seconds in sorted(self.seconds.items())}
+
+
+class MigrationBenchmark:
+    """
+    Runs DbDataModifier.process_db over a synthetic corpus in SQLite with the local storage backend and times the
+    stages: prepare, parse, asset resolution, upload and commit. Parsing and uploads run serially in the current
+    process and the sequential modify pass is used whatever MIGRATION_PIPELINE is, so the stage times add up to
+    the wall-clock time. The parse time is taken from the 'parse' stage of the migration metrics.
+    """
+    STAGES = ('prepare', 'parse', 'asset_resolution', 'upload', 'commit')
+
+    def __init__(self, corpus: SyntheticCorpusGenerator, work_dir: str, batch_size: int = 25,
+                 storage_latency: float = 0.0, storage_bandwidth: int = None):
+        self.corpus = corpus
+        self.work_dir = os.path.abspath(work_dir)
+        self.batch_size = batch_size
+        self.storage_latency = storage_latency
+        self.storage_bandwidth = storage_bandwidth
+
+    @property
+    def connection_string(self) -> str:
+        return f'sqlite:///{os.path.join(self.work_dir, "benchmark.sqlite3")}'
+
+    def prepare_corpus(self, engine):
+        mapper_registry.metadata.drop_all(engine)
+        mapper_registry.metadata.create_all(engine)
+
+        with DBSessionManager(engine) as current_session:
+            current_session.execute(insert(models.NewsContent), list(self.corpus.generate_news_contents()))
+
+        self.corpus.write_images(self.work_dir)
+
+    def run(self) -> dict:
+        engine = create_db_engine(self.connection_string)
+        self.prepare_corpus(engine)
+
+        storage_backend = LocalStorageBackend(os.path.join(self.work_dir, 'storage'), self.storage_latency,
+                                              self.storage_bandwidth)
+        file_uploader = FileUploader(file_upload_processor=FileUploadProcessor(storage_backend))
+        metrics = MigrationMetrics()
+        modifier = DbDataModifier(engine, batch_size=self.batch_size, assets_index=AssetsIndex(snapshot_path=None),
+                                  parse_workers=0, upload_workers=0, file_uploader=file_uploader, metrics=metrics,
+                                  pipeline=False)
+
+        stage_timer = StageTimer()
+        stage_timer.wrap(modifier, 'prepare_db_data', 'prepare')
+        stage_timer.wrap(modifier, '_extract_image_urls_into_assets', 'asset_resolution')
+        stage_timer.wrap(modifier, '_create_uploaded_assets', 'asset_resolution')
+        stage_timer.wrap(file_uploader, 'upload_file_from_path', 'upload')
+
+        def start_commit(_):
+            stage_timer.start('commit')
+
+        def stop_commit(_):
+            stage_timer.stop()
+
+        started_at = time.perf_counter()
+        try:
+            event.listen(Session, 'before_commit', start_commit)
+            event.listen(Session, 'after_commit', stop_commit)
+            with working_directory(self.work_dir):
+                modifier.process_db(resume=False)
+        finally:
+            total_seconds = time.perf_counter() - started_at
+            for identifier, listener in (('before_commit', start_commit), ('after_commit', stop_commit)):
+                if event.contains(Session, identifier, listener):
+                    event.remove(Session, identifier, listener)
+            engine.dispose()
+
+        self._add_parse_stage(stage_timer, metrics)
+        return self._get_results(stage_timer, total_seconds)
+
+    @staticmethod
+    def _add_parse_stage(stage_timer, metrics):
+        """
+        The 'parse' histogram also times the last wait of every batch, which ends without a result, so the calls
+        are the number of the parsed news contents.
+        """
+        summary = metrics.summary()
+        parse_seconds = summary['stages'].get('parse', {}).get('total_seconds', 0.0)
+        stage_timer.add('parse', parse_seconds, summary['counters'].get(MigrationMetrics.NEWS_CONTENTS_COUNTER, 0))
+
+    def _get_results(self, stage_timer, total_seconds) -> dict:
+        stages = stage_timer.to_dict()
+        for stage in self.STAGES:
+            stages.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+
+        return {
+            'version': get_code_version(),
+            'created_date': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'rows_count': self.corpus.rows_count,
+            'images_count': self.corpus.images_count,
+            'batch_size': self.batch_size,
+            'seed': self.corpus.seed,
+            'total_seconds': round(total_seconds, 6),
+            'rows_per_second': round(self.corpus.rows_count / total_seconds, 3) if total_seconds else 0.0,
+            'stages': stages,
+        }
+
+
+@contextmanager
+def working_directory(path):
+    """
+    The image paths of the articles are relative, the same as in the downloaded image folder.
+    """
+    current_path = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(current_path)
+
+
+def get_code_version() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the migration on a synthetic corpus.')
+    parser.add_argument('--rows', type=int, default=1000, help='number of news_content rows')
+    parser.add_argument('--images', type=int, default=None, help='number of distinct images')
+    parser.add_argument('--batch-size', type=int, default=25)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--storage-latency', type=float, default=0.0, help='seconds per upload request')
+    parser.add_argument('--storage-bandwidth', type=int, default=None, help='upload bytes per second')
+    parser.add_argument('--work-dir', default=None, help='directory for the DB, images and storage')
+    parser.add_argument('--output', default='bench_output.json', help='JSON file the results are written to')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    corpus = SyntheticCorpusGenerator(args.rows, images_count=args.images, seed=args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        benchmark = MigrationBenchmark(corpus, args.work_dir or tmp_dir, args.batch_size, args.storage_latency,
+                                       args.storage_bandwidth)
+        results = benchmark.run()
+
+    with open(args.output, 'w', encoding='utf-8') as output_file:
+        json.dump(results, output_file, indent=2)
+
+    logger.info(f'{results["rows_per_second"]} rows/s, results are written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, NamedTuple, Optional, Iterable
+
+import settings
+from db.engine import create_db_engine
+from db.sessions import DBSessionManager
+from processor import DbDataModifier, NewsContentService
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShardResult(NamedTuple):
+    shard_index: int
+    start_news_content_id: int
+    end_news_content_id: int
+    news_contents_count: int
+    duration: float
+
+    @property
+    def news_contents_per_second(self) -> float:
+        return self.news_contents_count / self.duration if self.duration else 0.0
+
+
+def modify_db_data_for_shard(connection_string: str, shard_index: int, start_news_content_id: int,
+                             end_news_content_id: int, resume: bool = False) -> ShardResult:
+    """
+    Runs in a worker process: every shard builds its own engine (and connection pool) and processes its
+    news_content_id interval with DbDataModifier.
+    """
+    engine = create_db_engine(connection_string)
+    started_at = time.perf_counter()
+
+    try:
+        news_contents_count = DbDataModifier(engine).modify_db_data_for_entities(
+            engine, start_news_content_id, end_news_content_id, resume)
+    finally:
+        engine.dispose()
+
+    return ShardResult(shard_index, start_news_content_id, end_news_content_id, news_contents_count,
+                       time.perf_counter() - started_at)
+
+
+class MigrationShardCoordinator:
+    """
+    Splits news_content_id into balanced ranges and runs DbDataModifier over every range in its own process.
+
+    Several machines sharing one database can split the work by running the same coordinator with different
+    'shard_indexes' (the ranges are computed the same way on every machine, so prepare the DB once beforehand
+    and run the other machines with MIGRATION_PREPARE=false).
+    """
+    def __init__(self, connection_string: str = settings.PROD_DB_CONNECTION_STRING,
+                 shards_count: int = settings.MIGRATION_SHARDS, max_workers: Optional[int] = None,
+                 shard_indexes: Optional[Iterable[int]] = settings.MIGRATION_SHARD_INDEXES,
+                 resume: bool = settings.MIGRATION_RESUME):
+        self.connection_string = connection_string
+        self.resume = resume
+        self.shards_count = shards_count
+        self.max_workers = max_workers or shards_count
+        self.shard_indexes = set(shard_indexes) if shard_indexes else None
+
+    def process_db(self, prepare: bool = settings.MIGRATION_PREPARE) -> List[ShardResult]:
+        engine = create_db_engine(self.connection_string)
+
+        try:
+            if prepare:
+                DbDataModifier(engine).prepare_db_data(self.resume)
+
+            with DBSessionManager(engine) as current_session:
+                news_content_id_ranges = NewsContentService(current_session).get_news_content_id_ranges(
+                    self.shards_count)
+        finally:
+            engine.dispose()
+
+        return self.modify_db_data(news_content_id_ranges)
+
+    def modify_db_data(self, news_content_id_ranges) -> List[ShardResult]:
+        shard_results = []
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(modify_db_data_for_shard, self.connection_string, shard_index, start_id, end_id,
+                                self.resume)
+                for shard_index, (start_id, end_id) in enumerate(news_content_id_ranges)
+                if self.shard_indexes is None or shard_index in self.shard_indexes
+            ]
+
+            for future in as_completed(futures):
+                shard_result = future.result()
+                shard_results.append(shard_result)
+                logger.info(f'Shard {shard_result.shard_index} '
+                            f'[{shard_result.start_news_content_id}, {shard_result.end_news_content_id}]: '
+                            f'{shard_result.news_contents_count} news in {shard_result.duration:.1f}s '
+                            f'({shard_result.news_contents_per_second:.1f} news/s)')
+
+        return sorted(shard_results)
@@ -0,0 +1,117 @@
+import logging
+from typing import Iterator, List, Optional, Tuple
+
+from sqlalchemy import select, insert
+
+import settings
+from db.sessions import DBSessionManager
+from utils import chunked
+
+
+logger = logging.getLogger(__name__)
+
+
+def iter_id_ranges(engine, id_column, chunk_size=settings.BULK_MUTATION_CHUNK_SIZE) \
+        -> Iterator[Tuple[Optional[int], Optional[int]]]:
+    """
+    Splits the table into '(lower_id, upper_id]' ranges of at most chunk_size rows, in the id order.
+    The lower bound of the first range and the upper bound of the last one are None (unbounded).
+    Every next range is looked up only when it is requested, i.e. after the previous range has been changed.
+    """
+    lower_id = None
+
+    while True:
+        id_stmt = select(id_column)
+        if lower_id is not None:
+            id_stmt = id_stmt.where(id_column > lower_id)
+
+        with DBSessionManager(engine) as current_session:
+            upper_id = current_session.scalar(id_stmt.order_by(id_column).offset(chunk_size - 1).limit(1))
+
+        yield lower_id, upper_id
+
+        if upper_id is None:
+            return
+        lower_id = upper_id
+
+
+def execute_in_id_ranges(engine, statement, id_column, chunk_size=settings.BULK_MUTATION_CHUNK_SIZE) -> List[int]:
+    """
+    Executes the UPDATE/DELETE statement range by range (see iter_id_ranges), every range in its own transaction.
+    A statement touches at most chunk_size rows, so it holds a limited number of row locks (SQL Server escalates
+    to a table lock at about 5000) and the transaction log is truncated between the chunks.
+    Returns the affected rows count of every chunk.
+    """
+    statement = statement.execution_options(synchronize_session=False)
+    affected_rows_counts = []
+
+    for lower_id, upper_id in iter_id_ranges(engine, id_column, chunk_size):
+        chunk_statement = statement
+        if lower_id is not None:
+            chunk_statement = chunk_statement.where(id_column > lower_id)
+        if upper_id is not None:
+            chunk_statement = chunk_statement.where(id_column <= upper_id)
+
+        with DBSessionManager(engine) as current_session:
+            affected_rows_count = current_session.execute(chunk_statement).rowcount
+
+        affected_rows_counts.append(affected_rows_count)
+        logger.info(f'{statement.table.name}: {affected_rows_count} rows are affected in the id range '
+                    f'({lower_id}, {upper_id}].')
+
+    return affected_rows_counts
+
+
+def get_rows_per_statement(parameters_per_row, parameter_limit=settings.SQL_SERVER_PARAMETER_LIMIT) -> int:
+    return max(parameter_limit // max(parameters_per_row, 1), 1)
+
+
+def get_rows_per_insert_statement(table, row: dict, parameter_limit=settings.SQL_SERVER_PARAMETER_LIMIT,
+                                  max_rows=settings.SQL_SERVER_MAX_VALUES_ROWS) -> int:
+    """
+    The rows of one multi-row 'INSERT INTO table VALUES (...), (...)': as many as fit into the parameter limit,
+    but no more than the VALUES list allows.
+    """
+    return min(get_rows_per_statement(get_parameters_per_row(table, row), parameter_limit), max_rows)
+
+
+def get_parameters_per_row(table, row: dict) -> int:
+    """
+    The number of parameters one row of 'INSERT INTO table' binds: the given values and the columns with
+    Python-side defaults (e.g. created_date), which are bound as parameters as well.
+    """
+    return len(insert(table).values(row).compile().params)
+
+
+def select_in_chunks(current_session, statement, column, values,
+                     parameter_limit=settings.SQL_SERVER_PARAMETER_LIMIT) -> list:
+    """
+    Executes 'statement WHERE column IN (values)' with as many statements as needed to keep every one of them
+    under the driver parameter limit (the parameters the statement already has are counted too) and returns
+    all the rows. The duplicated values are looked up once.
+    """
+    values = list(dict.fromkeys(values))
+    values_per_statement = get_rows_per_statement(1, parameter_limit - len(statement.compile().params))
+    rows = []
+
+    for values_chunk in chunked(values, values_per_statement):
+        rows += current_session.execute(statement.where(column.in_(values_chunk))).all()
+
+    return rows
+
+
+def insert_in_chunks(current_session, table, rows: List[dict], parameter_limit=settings.SQL_SERVER_PARAMETER_LIMIT,
+                     max_rows=settings.SQL_SERVER_MAX_VALUES_ROWS) -> int:
+    """
+    Inserts the rows (dicts with the same keys) with multi-row 'INSERT ... VALUES (...), (...)' statements,
+    each one with as many rows as fit into the driver parameter limit and at most max_rows rows.
+    Returns the number of inserted rows.
+    """
+    if not rows:
+        return 0
+
+    rows_per_statement = get_rows_per_insert_statement(table, rows[0], parameter_limit, max_rows)
+    for rows_chunk in chunked(rows, rows_per_statement):
+        current_session.execute(insert(table).values(rows_chunk))
+
+    return len(rows)
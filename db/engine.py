@@ -1,5 +1,41 @@
+import logging
+
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 
 import settings
 
-engine = create_engine(settings.PROD_DB_CONNECTION_STRING, echo=True)
+
+def get_engine_options(connection_string, pool_size=settings.DB_POOL_SIZE, max_overflow=settings.DB_MAX_OVERFLOW,
+                       pool_pre_ping=settings.DB_POOL_PRE_PING, fast_executemany=settings.DB_FAST_EXECUTEMANY,
+                       insertmanyvalues_page_size=settings.DB_INSERTMANYVALUES_PAGE_SIZE) -> dict:
+    """
+    The create_engine options supported by the DB of the connection string: SQLite has no sized connection pool,
+    'fast_executemany' (sending all the executemany parameter sets in one round trip) exists only in pyodbc.
+    """
+    url = make_url(connection_string)
+    engine_options = {'pool_pre_ping': pool_pre_ping, 'insertmanyvalues_page_size': insertmanyvalues_page_size}
+
+    if url.get_backend_name() != 'sqlite':
+        engine_options.update(pool_size=pool_size, max_overflow=max_overflow)
+
+    if url.get_backend_name() == 'mssql' and url.get_driver_name() == 'pyodbc':
+        engine_options['fast_executemany'] = fast_executemany
+
+    return engine_options
+
+
+def create_db_engine(connection_string=settings.PROD_DB_CONNECTION_STRING, log_level=settings.DB_LOG_LEVEL,
+                     pool_size=settings.DB_POOL_SIZE, max_overflow=settings.DB_MAX_OVERFLOW,
+                     pool_pre_ping=settings.DB_POOL_PRE_PING, fast_executemany=settings.DB_FAST_EXECUTEMANY,
+                     insertmanyvalues_page_size=settings.DB_INSERTMANYVALUES_PAGE_SIZE, **kwargs):
+    """
+    Builds an engine tuned by the DB_* settings; the other keyword arguments are passed to create_engine.
+    The SQL statements are logged only with log_level INFO (statements) or DEBUG (statements and rows):
+    formatting every statement and its parameters costs a lot on millions of statements.
+    """
+    logging.getLogger('sqlalchemy.engine').setLevel(log_level)
+
+    engine_options = get_engine_options(connection_string, pool_size, max_overflow, pool_pre_ping, fast_executemany,
+                                        insertmanyvalues_page_size)
+    return create_engine(connection_string, **engine_options, **kwargs)
@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import String, Integer, ForeignKey, DateTime, Table, Column, Text
+from sqlalchemy import String, Integer, ForeignKey, DateTime, Table, Column, Text, Boolean, BigInteger
 from sqlalchemy.dialects.mysql import JSON
 from sqlalchemy.orm import mapped_column, registry, relationship, DeclarativeBase
 
@@ -26,7 +26,7 @@ class Assets:
     __tablename__ = 'assets'
 
     asset_id = mapped_column(Integer, primary_key=True)
-    file_name = mapped_column(String(500))
+    file_name = mapped_column(String(500), unique=True)
 
     created_date = mapped_column(DateTime, default=datetime.utcnow)
     created_by_id = mapped_column(Integer)
@@ -59,3 +59,22 @@ class NewsContent:
 
     def __repr__(self) -> str:
         return f'NewsContent(pk={self.news_content_id},title={self.title})'
+
+
+@mapper_registry.mapped
+class MigrationProgress:
+    __tablename__ = 'migration_progress'
+
+    stage = mapped_column(String(100), primary_key=True)
+    last_news_content_id = mapped_column(Integer, nullable=True)
+    batches_count = mapped_column(Integer, default=0)
+    rows_count = mapped_column(Integer, default=0)
+    is_finished = mapped_column(Boolean, default=False)
+    last_byte_offset = mapped_column(BigInteger, nullable=True)
+
+    created_date = mapped_column(DateTime, default=datetime.utcnow)
+    updated_date = mapped_column(DateTime, default=datetime.utcnow)
+    finished_date = mapped_column(DateTime, nullable=True)
+
+    def __repr__(self) -> str:
+        return f'MigrationProgress(stage={self.stage},last_news_content_id={self.last_news_content_id})'
@@ -0,0 +1,201 @@
+import argparse
+import codecs
+import csv
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+
+import settings
+from db import models
+from db.bulk_operations import insert_in_chunks
+from db.engine import create_db_engine
+from db.models import mapper_registry
+from db.sessions import DBSessionManager
+from processor import MigrationProgressService
+
+
+logger = logging.getLogger(__name__)
+
+
+class CsvLineReader:
+    """
+    Iterates over the lines of a binary CSV file and keeps the byte offset of the end of the last line read.
+    csv.reader takes the lines one by one and does not read ahead, so after it returns a record the offset points
+    exactly to the beginning of the next record, even if the quoted fields of the record span several lines.
+    """
+    def __init__(self, csv_file, encoding='utf-8', offset=0):
+        self.csv_file = csv_file
+        self.encoding = encoding
+        self.offset = offset
+        self.csv_file.seek(offset)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        line = self.csv_file.readline()
+        if not line:
+            raise StopIteration
+
+        if self.offset == 0 and line.startswith(codecs.BOM_UTF8):
+            line = line[len(codecs.BOM_UTF8):]
+        self.offset = self.csv_file.tell()
+        return line.decode(self.encoding)
+
+
+class NewsContentCsvImporter:
+    """
+    Imports the CSV export of the Joomla body_content table into news_content.
+
+    The file is streamed record by record, so only one batch of rows is kept in memory. Every batch is inserted
+    with multi-row INSERT statements sized to the DB parameter limit and committed together with the byte offset
+    of its end in migration_progress; with resume=True the import continues after the last committed batch.
+    The csv field size limit is raised only for the time of the import and restored afterwards.
+    """
+    STAGE = 'import'
+    COLUMNS = {
+        'NewsContentId': 'news_content_id',
+        'Title': 'title',
+        'Text': 'text',
+        'CreatedDate': 'created_date',
+        'CreatedById': 'created_by_id',
+        'UpdatedDate': 'updated_date',
+        'UpdatedById': 'updated_by_id',
+        'ImagesData': 'view_data',
+    }
+    # a Joomla article text is easily longer than the default csv field limit (128 KB)
+    FIELD_SIZE_LIMIT = 2 ** 31 - 1
+    PROGRESS_INTERVAL = 10.0
+
+    def __init__(self, engine, csv_path: str, batch_size: int = settings.IMPORT_BATCH_SIZE, encoding: str = 'utf-8',
+                 delimiter: str = ','):
+        self.engine = engine
+        self.csv_path = csv_path
+        self.batch_size = batch_size
+        self.encoding = encoding
+        self.delimiter = delimiter
+
+    @property
+    def stage(self) -> str:
+        return f'{self.STAGE}:{os.path.basename(self.csv_path)}'
+
+    def import_csv(self, resume: bool = False) -> int:
+        field_size_limit = csv.field_size_limit(self.FIELD_SIZE_LIMIT)
+        try:
+            return self._import_csv(resume)
+        finally:
+            csv.field_size_limit(field_size_limit)
+
+    def _import_csv(self, resume: bool) -> int:
+        models.MigrationProgress.__table__.create(self.engine, checkfirst=True)
+
+        with DBSessionManager(self.engine) as current_session:
+            progress_service = MigrationProgressService(current_session)
+            if not resume:
+                progress_service.reset_stages(self.stage)
+
+            progress = progress_service.get_progress(self.stage)
+            if progress and progress.is_finished:
+                logger.info(f'{self.csv_path} is already imported, skipping it.')
+                return 0
+
+            last_byte_offset = progress.last_byte_offset if progress else None
+
+        rows_count = 0
+        started_at = reported_at = time.perf_counter()
+        file_size = os.path.getsize(self.csv_path)
+
+        for news_contents_values, byte_offset in self.iter_batches(last_byte_offset):
+            with DBSessionManager(self.engine) as current_session:
+                insert_in_chunks(current_session, models.NewsContent, news_contents_values)
+                MigrationProgressService(current_session).save_batch(
+                    self.stage, news_contents_values[-1]['news_content_id'], len(news_contents_values), byte_offset)
+            rows_count += len(news_contents_values)
+
+            if time.perf_counter() - reported_at >= self.PROGRESS_INTERVAL:
+                reported_at = time.perf_counter()
+                logger.info(f'{rows_count} rows are imported ({byte_offset / file_size:.1%} of {self.csv_path}, '
+                            f'{rows_count / (reported_at - started_at):.1f} rows/s).')
+
+        with DBSessionManager(self.engine) as current_session:
+            MigrationProgressService(current_session).finish_stage(self.stage)
+
+        logger.info(f'{rows_count} rows are imported from {self.csv_path} in {time.perf_counter() - started_at:.1f}s.')
+        return rows_count
+
+    def iter_batches(self, byte_offset: Optional[int] = None) -> Iterator[Tuple[List[dict], int]]:
+        """
+        Yields (news_content values, byte offset of the end of the batch) for every batch_size records
+        starting from byte_offset (the beginning of a record) or from the first record after the header.
+        """
+        news_contents_values = []
+
+        for news_content_values, record_end_offset in self.iter_records(byte_offset):
+            news_contents_values.append(news_content_values)
+
+            if len(news_contents_values) >= self.batch_size:
+                yield news_contents_values, record_end_offset
+                news_contents_values = []
+
+        if news_contents_values:
+            yield news_contents_values, record_end_offset
+
+    def iter_records(self, byte_offset: Optional[int] = None) -> Iterator[Tuple[dict, int]]:
+        with open(self.csv_path, 'rb') as csv_file:
+            header_reader = CsvLineReader(csv_file, self.encoding)
+            field_names = next(csv.reader(header_reader, delimiter=self.delimiter))
+
+            line_reader = CsvLineReader(csv_file, self.encoding, max(byte_offset or 0, header_reader.offset))
+            for record in csv.reader(line_reader, delimiter=self.delimiter):
+                if record:
+                    yield self.get_news_content_values(dict(zip(field_names, record))), line_reader.offset
+
+    def get_news_content_values(self, record: dict) -> dict:
+        news_content_values = {column_name: record.get(field_name) or None
+                               for field_name, column_name in self.COLUMNS.items()}
+
+        for column_name in ('news_content_id', 'created_by_id', 'updated_by_id'):
+            if news_content_values[column_name] is not None:
+                news_content_values[column_name] = int(news_content_values[column_name])
+
+        for column_name in ('created_date', 'updated_date'):
+            if news_content_values[column_name] is not None:
+                news_content_values[column_name] = self._parse_date(news_content_values[column_name])
+
+        if news_content_values['view_data'] is not None:
+            news_content_values['view_data'] = json.loads(news_content_values['view_data'])
+
+        news_content_values['text'] = news_content_values['text'] or ''
+        return news_content_values
+
+    @staticmethod
+    def _parse_date(value) -> Optional[datetime]:
+        # MySQL exports the empty dates as zero dates
+        return None if value.startswith('0000-00-00') else datetime.fromisoformat(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Imports the CSV export of body_content into news_content.')
+    parser.add_argument('csv_path')
+    parser.add_argument('--encoding', default='utf-8')
+    parser.add_argument('--delimiter', default=',')
+    parser.add_argument('--batch-size', type=int, default=settings.IMPORT_BATCH_SIZE, help='rows per transaction')
+    parser.add_argument('--create-tables', action='store_true', help='create the DB tables first')
+    parser.add_argument('--resume', action='store_true', help='continue after the last imported batch')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    engine = create_db_engine()
+
+    if args.create_tables:
+        mapper_registry.metadata.create_all(engine)
+
+    NewsContentCsvImporter(engine, args.csv_path, args.batch_size, args.encoding, args.delimiter).import_csv(
+        args.resume)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,13 @@
-from db.engine import engine
+import logging
+
+import settings
+from coordinator import MigrationShardCoordinator
+from db.engine import create_db_engine
 from processor import DbDataModifier
 
-DbDataModifier(engine).process_db()
+logging.basicConfig(level=logging.INFO)
+
+if settings.MIGRATION_SHARDS > 1:
+    MigrationShardCoordinator().process_db()
+else:
+    DbDataModifier(create_db_engine()).process_db()
@@ -1,19 +1,24 @@
+import json
 import logging
-import math
+import os
 from datetime import datetime
+from functools import partial
+from typing import List, Optional, Tuple, Dict, NamedTuple, Iterable
 
-from sqlalchemy import select, insert, update, delete, not_, create_engine
-from sqlalchemy.exc import OperationalError
-from sqlalchemy.sql.functions import count
+from sqlalchemy import select, insert, update, delete, not_, bindparam
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.sql.functions import count, func
 
+import settings
 from db import models
+from db.bulk_operations import execute_in_id_ranges, select_in_chunks, insert_in_chunks, \
+    get_rows_per_insert_statement
 from db.sessions import DBSessionManager
-from services.file_uploader import FileUploader
-from services.parsers import ParseTextFromHtmlService, ParseAbsoluteToDomesticUrlService
-
-
-logging.basicConfig()
-logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
+from services.file_uploader import FileUploader, FileUploadPool
+from services.metrics import MigrationMetrics, MetricsReporter, get_shared_migration_metrics
+from services.parsers import ParseAbsoluteToDomesticUrlService, ParallelParseService, parse_image_sources
+from services.pipeline import StagedPipeline
+from utils import chunked
 
 
 DEBUG_MODE = False
@@ -22,6 +27,11 @@ TEST_DEFAULT_AFFECTED_ROW_COUNT = 2
 BATCH_SIZE = 25
 
 
+class NewsContentText(NamedTuple):
+    news_content_id: int
+    text: str
+
+
 class SessionMixin:
     def __init__(self, current_session):
         self.session = current_session
@@ -33,41 +43,238 @@ class NewsContentAssetsService(SessionMixin):
                                                                           asset_id=asset_id)
         return self.session.execute(news_content_asset_stmt)
 
+    def create_references_between_news_and_assets(self, news_content_id, asset_ids):
+        if not asset_ids:
+            return
+
+        news_content_assets_values = [{'news_content_id': news_content_id, 'asset_id': asset_id}
+                                      for asset_id in asset_ids]
+        return self.session.execute(insert(models.NewsContentAssets), news_content_assets_values)
+
+
+class NewsContentAssetsWriter(NewsContentAssetsService):
+    """
+    Collects the news_content_assets links of a whole batch and writes them with one multi-row INSERT.
+    The links which already exist in the DB are loaded once per batch and skipped with a set lookup.
+    """
+    def __init__(self, current_session):
+        super().__init__(current_session)
+        self.existing_links = set()
+        self.pending_links = {}
+        self.linked_news_content_ids = set()
+
+    def load_existing_links(self, news_content_ids):
+        news_content_assets_stmt = select(models.NewsContentAssets.c.news_content_id,
+                                          models.NewsContentAssets.c.asset_id)
+        return self.add_existing_links(select_in_chunks(
+            self.session, news_content_assets_stmt, models.NewsContentAssets.c.news_content_id, news_content_ids))
+
+    def add_existing_links(self, links):
+        """
+        Takes the (news_content_id, asset_id) links which have already been loaded, e.g. by another session.
+        """
+        self.existing_links.update(tuple(link) for link in links)
+        self.linked_news_content_ids.update(news_content_id for news_content_id, _ in self.existing_links)
+        return self
+
+    def has_links(self, news_content_id) -> bool:
+        return news_content_id in self.linked_news_content_ids
+
+    def add(self, news_content_id, asset_id):
+        link = (news_content_id, asset_id)
+        if link not in self.existing_links:
+            self.pending_links.setdefault(link, None)
+            self.linked_news_content_ids.add(news_content_id)
+
+    def flush(self):
+        if not self.pending_links:
+            return
+
+        news_content_assets_values = [{'news_content_id': news_content_id, 'asset_id': asset_id}
+                                      for news_content_id, asset_id in self.pending_links]
+        insert_in_chunks(self.session, models.NewsContentAssets, news_content_assets_values)
+
+        self.existing_links.update(self.pending_links)
+        self.pending_links.clear()
+
 
 class AssetsService(NewsContentAssetsService):
     DEFAULT_USER_ID = 1
 
     def create_asset(self, file_name):
-        asset_insert_stmt = insert(models.Assets).values(file_name=file_name, created_by_id=self.DEFAULT_USER_ID,
-                                                         updated_by_id=self.DEFAULT_USER_ID)
-        self.session.execute(asset_insert_stmt)
-
-        asset_select_stmt = select(models.Assets).order_by(models.Assets.asset_id.desc())
-        return self.session.scalar(asset_select_stmt)
+        asset_insert_stmt = insert(models.Assets).values(**self._get_asset_values(file_name)).returning(models.Assets)
+        return self.session.scalar(asset_insert_stmt)
 
     def create_asset_with_reference(self, news_content_id, file_name):
-        asset_insert_stmt = insert(models.Assets).values(file_name=file_name, created_by_id=self.DEFAULT_USER_ID,
-                                                         updated_by_id=self.DEFAULT_USER_ID)
-        self.session.execute(asset_insert_stmt)
+        asset = self.create_asset(file_name)
+        self.create_reference_between_news_and_assets(news_content_id, asset.asset_id)
+        return asset
+
+    def create_assets(self, file_names) -> List[int]:
+        """
+        Inserts the assets with as few statements as the parameter limit allows (INSERT ... RETURNING / OUTPUT
+        through SQLAlchemy insertmanyvalues) and returns the new asset ids in the order of the given file names.
+        The ids are matched by the returned (unique) file names, so the rows may come back in any order and
+        the statements are batched on every dialect, also the ones without an insert sentinel (SQLite).
+
+        If another worker has created some of the assets meanwhile (unique assets.file_name), the existing assets
+        are looked up in bulk and reused, the missing ones are created one by one.
+        """
+        if not file_names:
+            return []
+
+        asset_insert_stmt = insert(models.Assets).returning(models.Assets.file_name, models.Assets.asset_id)
+        assets_values = [self._get_asset_values(file_name) for file_name in file_names]
+        rows_per_statement = get_rows_per_insert_statement(models.Assets, assets_values[0])
+        asset_ids_by_file_name = {}
+
+        try:
+            with self.session.begin_nested():
+                for assets_values_chunk in chunked(assets_values, rows_per_statement):
+                    asset_ids_by_file_name.update(self.session.execute(asset_insert_stmt, assets_values_chunk).all())
+            return [asset_ids_by_file_name[file_name] for file_name in file_names]
+        except IntegrityError:
+            asset_ids_by_file_name = self.get_asset_ids_by_file_names(file_names)
+            return [asset_ids_by_file_name.get(file_name) or self.get_or_create_asset_id(file_name)
+                    for file_name in file_names]
+
+    def get_or_create_asset_id(self, file_name) -> int:
+        asset = self.get_asset_by_file_name(file_name)
+        if asset:
+            return asset.asset_id
+
+        try:
+            with self.session.begin_nested():
+                return self.create_asset(file_name).asset_id
+        except IntegrityError:
+            return self.get_asset_by_file_name(file_name).asset_id
 
-        asset_select_stmt = select(models.Assets).order_by(models.Assets.asset_id.desc())
-        asset = self.session.scalar(asset_select_stmt)
+    def create_assets_with_references(self, news_content_id, file_names) -> List[int]:
+        asset_ids = self.create_assets(file_names)
+        self.create_references_between_news_and_assets(news_content_id, asset_ids)
+        return asset_ids
 
-        self.create_reference_between_news_and_assets(news_content_id, asset.asset_id)
+    def _get_asset_values(self, file_name) -> dict:
+        return {'file_name': file_name, 'created_by_id': self.DEFAULT_USER_ID, 'updated_by_id': self.DEFAULT_USER_ID}
 
     def get_asset_by_file_name(self, file_name):
         assets_stmt = select(models.Assets).where(models.Assets.file_name == f'{file_name}')
         return self.session.scalars(assets_stmt).first()
 
+    def get_asset_ids_by_file_names(self, file_names) -> Dict[str, int]:
+        assets_stmt = select(models.Assets.file_name, models.Assets.asset_id)
+        return {file_name: asset_id
+                for file_name, asset_id in select_in_chunks(self.session, assets_stmt, models.Assets.file_name,
+                                                            file_names)}
+
+
+class AssetsIndex:
+    """
+    In-memory 'file_name -> asset_id' index of the assets table.
+
+    It is loaded once with a single query, kept up to date by the processor as assets are created and serves
+    every lookup from a dict. If snapshot_path is set, the index is also stored to disk as JSON, so the next run
+    only has to load the assets created after the snapshot. The snapshot keeps the number of the indexed assets
+    and the last asset (id and file name); it is discarded unless the DB has as many assets up to that id and
+    the same last asset, because after a DB reset or a re-import its ids may point to other assets or to none.
+    """
+    def __init__(self, snapshot_path: Optional[str] = settings.ASSETS_INDEX_SNAPSHOT_PATH):
+        self.snapshot_path = snapshot_path
+        self.asset_ids_by_file_name = {}
+        self.assets_count = 0
+        self.last_asset_id = None
+        self.last_file_name = None
+        self.is_loaded = False
+
+    def __len__(self):
+        return len(self.asset_ids_by_file_name)
+
+    def __contains__(self, file_name):
+        return file_name in self.asset_ids_by_file_name
+
+    def load(self, current_session):
+        self._load_snapshot(current_session)
+
+        assets_stmt = select(models.Assets.file_name, models.Assets.asset_id).order_by(models.Assets.asset_id)
+        if self.last_asset_id is not None:
+            assets_stmt = assets_stmt.where(models.Assets.asset_id > self.last_asset_id)
+
+        for file_name, asset_id in current_session.execute(assets_stmt):
+            self.add(file_name, asset_id)
+
+        self.is_loaded = True
+        return self
+
+    def get_asset_id(self, file_name) -> Optional[int]:
+        return self.asset_ids_by_file_name.get(file_name)
+
+    def add(self, file_name, asset_id):
+        """
+        Has to be called once for every asset, the count of the added assets is a part of the snapshot.
+        """
+        self.asset_ids_by_file_name.setdefault(file_name, asset_id)
+        self.assets_count += 1
+        if self.last_asset_id is None or asset_id > self.last_asset_id:
+            self.last_asset_id, self.last_file_name = asset_id, file_name
+
+    def _load_snapshot(self, current_session):
+        if not (self.snapshot_path and os.path.exists(self.snapshot_path)):
+            return
+
+        with open(self.snapshot_path, encoding='utf-8') as snapshot_file:
+            snapshot = json.load(snapshot_file)
+
+        if not self._is_snapshot_valid(snapshot, current_session):
+            logging.warning(f'The assets index snapshot {self.snapshot_path} does not match the DB, '
+                            f'the whole index is loaded from the DB.')
+            return
+
+        self.asset_ids_by_file_name.update(snapshot['asset_ids_by_file_name'])
+        self.assets_count = snapshot['assets_count']
+        self.last_asset_id = snapshot['last_asset_id']
+        self.last_file_name = snapshot['last_file_name']
+
+    @staticmethod
+    def _is_snapshot_valid(snapshot, current_session) -> bool:
+        if not isinstance(snapshot, dict) or 'asset_ids_by_file_name' not in snapshot:
+            return False
+        if snapshot['last_asset_id'] is None:
+            return not snapshot['assets_count']
+
+        assets_count_stmt = select(count(models.Assets.asset_id)).where(
+            models.Assets.asset_id <= snapshot['last_asset_id'])
+        last_file_name_stmt = select(models.Assets.file_name).where(
+            models.Assets.asset_id == snapshot['last_asset_id'])
+        return (current_session.scalar(assets_count_stmt) == snapshot['assets_count']
+                and current_session.scalar(last_file_name_stmt) == snapshot['last_file_name'])
+
+    def save_snapshot(self):
+        if not self.snapshot_path:
+            return
+
+        snapshot = {
+            'assets_count': self.assets_count,
+            'last_asset_id': self.last_asset_id,
+            'last_file_name': self.last_file_name,
+            'asset_ids_by_file_name': self.asset_ids_by_file_name,
+        }
+        tmp_snapshot_path = f'{self.snapshot_path}.tmp'
+        with open(tmp_snapshot_path, 'w', encoding='utf-8') as snapshot_file:
+            json.dump(snapshot, snapshot_file, separators=(',', ':'))
+        os.replace(tmp_snapshot_path, self.snapshot_path)
+
 
 class NewsContentService(SessionMixin):
     def clean_view_data_field(self):
         if DEBUG_MODE:
             return self._DEBUG_clean_view_data_field()
 
-        news_content_stmt = update(models.NewsContent).values(view_data=None).where(
+        self.session.execute(self.get_clean_view_data_field_stmt())
+
+    @staticmethod
+    def get_clean_view_data_field_stmt():
+        return update(models.NewsContent).values(view_data=None).where(
             not_(models.NewsContent.view_data.contains('youtube')))
-        self.session.execute(news_content_stmt)
 
     def _DEBUG_clean_view_data_field(self):
         news_content_select_stmt = select(models.NewsContent.news_content_id).order_by(
@@ -86,6 +293,87 @@ class NewsContentService(SessionMixin):
         news_content_stmt = select(models.NewsContent).order_by(models.NewsContent.news_content_id.desc()).offset(offset)
         return self.session.scalars(news_content_stmt).all()
 
+    def get_news_contents_page(self, last_news_content_id=None, limit=BATCH_SIZE, start_id=None):
+        if DEBUG_MODE:
+            return self._DEBUG_get_news_contents_page(last_news_content_id)
+
+        news_content_stmt = select(models.NewsContent)
+        if last_news_content_id is not None:
+            news_content_stmt = news_content_stmt.where(models.NewsContent.news_content_id < last_news_content_id)
+        if start_id is not None:
+            news_content_stmt = news_content_stmt.where(models.NewsContent.news_content_id >= start_id)
+
+        news_content_stmt = news_content_stmt.order_by(models.NewsContent.news_content_id.desc()).limit(limit)
+        return self.session.scalars(news_content_stmt).all()
+
+    def get_news_content_texts_page(self, last_news_content_id=None, limit=BATCH_SIZE,
+                                    start_id=None) -> List[NewsContentText]:
+        """
+        The same page as get_news_contents_page, but only the news_content_id and text columns as NewsContentText
+        tuples: no ORM objects, identity map entries or change tracking for the rows which are only read.
+        """
+        if DEBUG_MODE:
+            limit = TEST_DEFAULT_AFFECTED_ROW_COUNT if last_news_content_id is None else 0
+
+        news_content_stmt = select(models.NewsContent.news_content_id, models.NewsContent.text)
+        if last_news_content_id is not None:
+            news_content_stmt = news_content_stmt.where(models.NewsContent.news_content_id < last_news_content_id)
+        if start_id is not None:
+            news_content_stmt = news_content_stmt.where(models.NewsContent.news_content_id >= start_id)
+
+        news_content_stmt = news_content_stmt.order_by(models.NewsContent.news_content_id.desc()).limit(limit)
+        return [NewsContentText._make(row) for row in self.session.execute(news_content_stmt).tuples()]
+
+    def get_news_content_images_page(self, last_news_content_id=None, limit=BATCH_SIZE) -> list:
+        """
+        The same keyset page as get_news_contents_page, but only the (news_content_id, view_data, text) rows.
+        """
+        news_content_stmt = select(models.NewsContent.news_content_id, models.NewsContent.view_data,
+                                   models.NewsContent.text)
+        if last_news_content_id is not None:
+            news_content_stmt = news_content_stmt.where(models.NewsContent.news_content_id < last_news_content_id)
+
+        news_content_stmt = news_content_stmt.order_by(models.NewsContent.news_content_id.desc()).limit(limit)
+        return self.session.execute(news_content_stmt).all()
+
+    def update_news_content_texts(self, news_content_texts: Iterable[NewsContentText], updated_date=None):
+        """
+        Writes the texts with one executemany of a Core UPDATE by news_content_id (see get_update_texts_stmt),
+        bypassing the ORM unit of work.
+        """
+        updated_date = updated_date or datetime.utcnow()
+        news_content_values = [{'b_news_content_id': news_content_id, 'b_text': text, 'b_updated_date': updated_date}
+                               for news_content_id, text in news_content_texts]
+        if news_content_values:
+            self.session.execute(self.get_update_texts_stmt(), news_content_values)
+
+    @staticmethod
+    def get_update_texts_stmt():
+        news_content_table = models.NewsContent.__table__
+        return update(news_content_table).where(
+            news_content_table.c.news_content_id == bindparam('b_news_content_id')).values(
+            text=bindparam('b_text'), updated_date=bindparam('b_updated_date'))
+
+    def update_news_content_youtube_urls(self, youtube_urls_by_news_content_id: Dict[int, List[str]]):
+        """
+        Replaces the view_data of the news contents with {'youtube': [urls]}, one executemany for all of them.
+        """
+        news_content_values = [{'b_news_content_id': news_content_id, 'b_view_data': {'youtube': youtube_urls}}
+                               for news_content_id, youtube_urls in youtube_urls_by_news_content_id.items()]
+        if not news_content_values:
+            return
+
+        news_content_table = models.NewsContent.__table__
+        news_content_stmt = update(news_content_table).where(
+            news_content_table.c.news_content_id == bindparam('b_news_content_id')).values(
+            view_data=bindparam('b_view_data'))
+        self.session.execute(news_content_stmt, news_content_values)
+
+    def _DEBUG_get_news_contents_page(self, last_news_content_id):
+        if last_news_content_id is not None:
+            return []
+        return self._DEBUG_get_news_contents()
+
     def get_news_contents_from_interval(self, start_id, end_id):
         news_content_stmt = select(models.NewsContent).where(
             models.NewsContent.news_content_id >= start_id,
@@ -94,6 +382,19 @@ class NewsContentService(SessionMixin):
             models.NewsContent.news_content_id.desc())
         return self.session.scalars(news_content_stmt).all()
 
+    def get_news_content_id_ranges(self, ranges_count) -> List[Tuple[int, int]]:
+        """
+        Splits news_content_id into 'ranges_count' intervals with the same number of rows (NTILE quantiles).
+        """
+        tile = func.ntile(ranges_count).over(order_by=models.NewsContent.news_content_id).label('tile')
+        news_content_tiles = select(models.NewsContent.news_content_id, tile).subquery()
+
+        news_content_ranges_stmt = select(
+            func.min(news_content_tiles.c.news_content_id),
+            func.max(news_content_tiles.c.news_content_id),
+        ).group_by(news_content_tiles.c.tile).order_by(news_content_tiles.c.tile)
+        return [(start_id, end_id) for start_id, end_id in self.session.execute(news_content_ranges_stmt)]
+
     def _DEBUG_get_news_contents(self):
         news_content_stmt = select(models.NewsContent).order_by(models.NewsContent.news_content_id.desc()).limit(
             TEST_DEFAULT_AFFECTED_ROW_COUNT)
@@ -123,34 +424,124 @@ class NewsContentService(SessionMixin):
         return self.session.scalars(news_content_stmt).all()
 
 
+class MigrationProgressService(SessionMixin):
+    """
+    Checkpoints of the migration stages. A checkpoint is written in the same transaction as the batch it
+    describes, so after a crash it points exactly to the last committed batch.
+    """
+    def get_progress(self, stage) -> Optional[models.MigrationProgress]:
+        return self.session.get(models.MigrationProgress, stage)
+
+    def is_stage_finished(self, stage) -> bool:
+        progress = self.get_progress(stage)
+        return bool(progress and progress.is_finished)
+
+    def save_batch(self, stage, last_news_content_id, rows_count, last_byte_offset=None):
+        progress = self._get_or_create_progress(stage)
+        progress.last_news_content_id = last_news_content_id
+        progress.last_byte_offset = last_byte_offset
+        progress.batches_count += 1
+        progress.rows_count += rows_count
+        progress.updated_date = datetime.utcnow()
+
+    def finish_stage(self, stage):
+        progress = self._get_or_create_progress(stage)
+        progress.is_finished = True
+        progress.updated_date = progress.finished_date = datetime.utcnow()
+
+    def reset_stages(self, *stages):
+        self.session.execute(delete(models.MigrationProgress).where(models.MigrationProgress.stage.in_(stages)))
+
+    def _get_or_create_progress(self, stage) -> models.MigrationProgress:
+        progress = self.get_progress(stage)
+        if progress is None:
+            progress = models.MigrationProgress(stage=stage, batches_count=0, rows_count=0, is_finished=False)
+            self.session.add(progress)
+        return progress
+
+
 class DbPreparingService:
-    def __init__(self, engine):
+    """
+    The prepare passes go over news_content in keyset chunks of batch_size rows: every chunk is read, changed and
+    committed in its own session, so only one chunk of ORM objects is kept in memory however big the table is.
+    The last committed chunk of every pass is checkpointed, a restarted pass continues after it.
+
+    The youtube urls are not extracted here: the modify pass parses every article anyway and writes them into
+    view_data from the same parse result (see DbDataModifier._write_youtube_urls).
+    """
+    MAIN_IMAGE_STAGE = 'prepare:main_image'
+    STAGES = (MAIN_IMAGE_STAGE,)
+
+    def __init__(self, engine, assets_index: Optional[AssetsIndex] = None,
+                 file_uploader: Optional[FileUploader] = None, batch_size=settings.PREPARE_BATCH_SIZE,
+                 mutation_chunk_size=settings.BULK_MUTATION_CHUNK_SIZE,
+                 unresolved_images: Optional[Dict[str, List[int]]] = None):
         self.engine = engine
+        self.assets_index = assets_index if assets_index is not None else AssetsIndex()
+        self.file_uploader = file_uploader or FileUploader()
+        self.batch_size = batch_size
+        self.mutation_chunk_size = mutation_chunk_size
+        self.unresolved_images = unresolved_images if unresolved_images is not None else {}
 
     def prepare_db_data(self):
+        self._delete_duplicated_news_or_extra_staff()
+
+        if not self.assets_index.is_loaded:
+            with DBSessionManager(self.engine) as current_session:
+                self.assets_index.load(current_session)
+
+        for news_contents, current_session in self._iter_news_content_chunks(
+                self.MAIN_IMAGE_STAGE, NewsContentService.get_news_contents_page):
+            for news_content in news_contents:
+                self._extract_main_img_url_into_news_content(news_content, current_session)
+
+        self._clean_view_data_field()
+
+    def _iter_news_content_chunks(self, stage, get_news_contents_page):
+        """
+        Yields (news_contents, session) chunks; the chunk is committed together with its checkpoint after the
+        caller has processed it, and the session is closed, which releases the ORM objects of the chunk.
+        """
         with DBSessionManager(self.engine) as current_session:
-            self._delete_duplicated_news_or_extra_staff(current_session)
-            news_service = NewsContentService(current_session)
+            progress = MigrationProgressService(current_session).get_progress(stage)
+            if progress and progress.is_finished:
+                logging.info(f'Stage {stage} is already finished, skipping it.')
+                return
 
-            for news_content in news_service.get_news_contents():
-                news_content = self._extract_main_img_url_into_news_content(news_content, current_session)
-            current_session.commit()
+            last_news_content_id = progress.last_news_content_id if progress else None
 
-            for news_content in news_service.get_news_contents_with_youtube_urls():
-                news_content = self._extract_youtube_urls_into_news_content_view_data(news_content)
-            current_session.commit()
+        while True:
+            with DBSessionManager(self.engine) as current_session:
+                news_service = NewsContentService(current_session)
+                news_contents = get_news_contents_page(news_service, last_news_content_id, self.batch_size)
+                if not news_contents:
+                    break
 
-            news_service.clean_view_data_field()
-            news_content.updated_date = datetime.utcnow()
-            current_session.commit()
+                last_news_content_id = news_contents[-1].news_content_id
+                yield news_contents, current_session
 
-    @staticmethod
-    def _delete_duplicated_news_or_extra_staff(current_session):
+                MigrationProgressService(current_session).save_batch(stage, last_news_content_id,
+                                                                     len(news_contents))
+
+        with DBSessionManager(self.engine) as current_session:
+            MigrationProgressService(current_session).finish_stage(stage)
+
+    def _delete_duplicated_news_or_extra_staff(self):
         news_content_stmt = delete(models.NewsContent).where(models.NewsContent.text == '')
-        current_session.execute(news_content_stmt)
+        deleted_rows_count = sum(execute_in_id_ranges(self.engine, news_content_stmt,
+                                                      models.NewsContent.news_content_id, self.mutation_chunk_size))
+        logging.info(f'{deleted_rows_count} empty news contents are deleted.')
 
-    @staticmethod
-    def _extract_main_img_url_into_news_content(news_content, current_session):
+    def _clean_view_data_field(self):
+        if DEBUG_MODE:
+            with DBSessionManager(self.engine) as current_session:
+                return NewsContentService(current_session).clean_view_data_field()
+
+        cleaned_rows_count = sum(execute_in_id_ranges(self.engine, NewsContentService.get_clean_view_data_field_stmt(),
+                                                      models.NewsContent.news_content_id, self.mutation_chunk_size))
+        logging.info(f'view_data is cleaned in {cleaned_rows_count} news contents.')
+
+    def _extract_main_img_url_into_news_content(self, news_content, current_session):
         absolute_main_image_url = news_content.view_data.get('image_intro', None) if news_content.view_data else None
 
         if not absolute_main_image_url:
@@ -159,91 +550,410 @@ class DbPreparingService:
         image_path = ParseAbsoluteToDomesticUrlService().parse_url(absolute_main_image_url)
         file_name = FileUploader.get_file_name_by_path(image_path)
 
-        asset = AssetsService(current_session).get_asset_by_file_name(file_name)
-        if asset:
-            news_content.main_asset_id = asset.asset_id
+        if file_name not in self.assets_index and not self.file_uploader.is_resolved(image_path):
+            self.unresolved_images.setdefault(image_path, []).append(news_content.news_content_id)
+            return news_content
+
+        asset_id = self.assets_index.get_asset_id(file_name)
+        if asset_id:
+            news_content.main_asset_id = asset_id
+            news_content.updated_date = datetime.utcnow()
         else:
-            file_name = FileUploader().upload_file_from_path(image_path)
+            file_name = self.file_uploader.upload_file_from_path(image_path)
             if file_name:
-                asset = AssetsService(current_session).create_asset(file_name)
-                news_content.main_asset_id = asset.asset_id
+                asset_id = self.assets_index.get_asset_id(file_name)
+                if asset_id is None:
+                    asset_id, = AssetsService(current_session).create_assets([file_name])
+                    self.assets_index.add(file_name, asset_id)
+                news_content.main_asset_id = asset_id
+                news_content.updated_date = datetime.utcnow()
 
         return news_content
 
-    @staticmethod
-    def _extract_youtube_urls_into_news_content_view_data(news_content):
-        parse_service = ParseTextFromHtmlService(news_content.text)
-        youtube_urls = parse_service.parse_youtube_urls()
-
-        if not ('youtube' in news_content.view_data):
-            news_content.view_data = {}
-
-        news_content.view_data.update({'youtube': youtube_urls})
-        return news_content
-
 
 class DbDataModifier:
     DEFAULT_USER_ID = 1
     TEST_DEFAULT_AFFECTED_ROW_COUNT = 2
 
-    def __init__(self, engine):
-        self.engine = engine
+    PREPARE_STAGE = 'prepare'
+    MODIFY_STAGE = 'modify'
 
-    def process_db(self):
+    def __init__(self, engine, batch_size=settings.MODIFY_BATCH_SIZE, assets_index: Optional[AssetsIndex] = None,
+                 parse_workers=settings.PARSE_WORKERS, upload_workers=settings.UPLOAD_WORKERS,
+                 file_uploader: Optional[FileUploader] = None, metrics: Optional[MigrationMetrics] = None,
+                 pipeline=settings.MIGRATION_PIPELINE):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.pipeline = pipeline
+        self.assets_index = assets_index if assets_index is not None else AssetsIndex()
+        self.metrics = metrics or get_shared_migration_metrics()
+        self.metrics.instrument_engine(engine)
+        self.file_uploader = file_uploader or FileUploader(metrics=self.metrics)
+        self.parse_service = ParallelParseService(parse_workers)
+        self.upload_pool = FileUploadPool(upload_workers, file_uploader=self.file_uploader)
+        self.unresolved_images: Dict[str, List[int]] = {}
+
+    def process_db(self, resume=settings.MIGRATION_RESUME):
+        """
+        With resume=True the stages finished by the previous run are skipped and the modify stage continues
+        after the last committed batch; otherwise the checkpoints are reset and the migration starts over.
+        """
         try:
-            DbPreparingService(self.engine).prepare_db_data()
-            self._modify_db_data()
+            with MetricsReporter(self.metrics):
+                self._prepare_progress(self.engine, resume, self.MODIFY_STAGE)
+                self.prepare_db_data(resume)
+                self._modify_db_data()
+                self.assets_index.save_snapshot()
         except OperationalError as e:
             logging.error(f'Database Error: {e}')
+        finally:
+            self.report_unresolved_images()
+            self._close_executors()
+
+    def check_unresolved_images(self, engine=None) -> Dict[str, List[int]]:
+        """
+        Checks the images of all the articles against the image index of the file uploader before anything is
+        uploaded and reports the missing ones at once. Only the news_content_id, view_data and text columns are
+        read and the HTML is only scanned for the 'img' sources; the images which already have an asset are not
+        checked. Nothing is checked if the file uploader has no image index.
+        """
+        image_index = self.file_uploader.image_index
+        if image_index is None:
+            return self.unresolved_images
+
+        last_news_content_id = None
+        while True:
+            with DBSessionManager(engine or self.engine) as current_session:
+                news_contents = NewsContentService(current_session).get_news_content_images_page(
+                    last_news_content_id, settings.PREPARE_BATCH_SIZE)
+            if not news_contents:
+                break
+
+            last_news_content_id = news_contents[-1].news_content_id
+            news_content_ids_by_image_path = {}
+            for news_content_id, view_data, text in news_contents:
+                main_image_url = view_data.get('image_intro') if view_data else None
+                image_paths = parse_image_sources(text or '')
+                if main_image_url:
+                    image_paths.append(ParseAbsoluteToDomesticUrlService().parse_url(main_image_url))
+
+                for image_path in filter(None, image_paths):
+                    if FileUploader.get_file_name_by_path(image_path) not in self.assets_index:
+                        news_content_ids_by_image_path.setdefault(image_path, []).append(news_content_id)
+
+            for image_path in image_index.find_unresolved(news_content_ids_by_image_path):
+                self.unresolved_images.setdefault(image_path, []).extend(news_content_ids_by_image_path[image_path])
+
+        return self.report_unresolved_images()
+
+    def report_unresolved_images(self, report_path=settings.UNRESOLVED_IMAGES_REPORT_PATH) -> Dict[str, List[int]]:
+        """
+        Reports the images (the main images and the images of the HTML) which are not found in the image index
+        of the file uploader, as {image path: news_content ids}. They are checked before the prepare stage and
+        recorded again by the prepare and modify passes, which do not submit them for upload at all; the report
+        is written at the end of the run, also if it fails.
+        """
+        image_index = self.file_uploader.image_index
+        unresolved_images = {image_path: list(dict.fromkeys(news_content_ids))
+                             for image_path, news_content_ids in self.unresolved_images.items()}
+        if unresolved_images:
+            logging.warning(f'{len(unresolved_images)} images are not found in {image_index.root_path}: '
+                            f'{", ".join(list(unresolved_images)[:20])}{" ..." if len(unresolved_images) > 20 else ""}')
+        if report_path and image_index is not None:
+            with open(report_path, 'w', encoding='utf-8') as report_file:
+                json.dump(unresolved_images, report_file, indent=2)
+
+        return unresolved_images
+
+    def _close_executors(self):
+        self.parse_service.close()
+        self.upload_pool.close()
+        if self.file_uploader.image_optimizer is not None:
+            self.file_uploader.image_optimizer.close()
 
-    def modify_db_data_for_entities(self, engine, start_news_content_id, end_news_content_id):
-        with DBSessionManager(engine) as current_session:
-            news_service = NewsContentService(current_session)
-            news_contents = news_service.get_news_contents_from_interval(start_news_content_id, end_news_content_id)
-            self._modify_db_data_partial(news_contents, current_session)
+    @staticmethod
+    def _prepare_progress(engine, resume, *stages):
+        models.MigrationProgress.__table__.create(engine, checkfirst=True)
 
-            current_session.commit()
+        if not resume:
+            with DBSessionManager(engine) as current_session:
+                MigrationProgressService(current_session).reset_stages(*stages)
+
+    def prepare_db_data(self, resume=settings.MIGRATION_RESUME):
+        self._prepare_progress(self.engine, resume, self.PREPARE_STAGE, *DbPreparingService.STAGES)
+        self._load_assets_index()
 
-    def _modify_db_data(self, ):
         with DBSessionManager(self.engine) as current_session:
-            news_service = NewsContentService(current_session)
+            if MigrationProgressService(current_session).is_stage_finished(self.PREPARE_STAGE):
+                logging.info('Prepare stage is already finished, skipping it.')
+                return
 
-            total_news_count = news_service.get_news_contents_count()
-            iter_times = math.ceil(total_news_count / BATCH_SIZE)
+        self.check_unresolved_images()
+        DbPreparingService(self.engine, self.assets_index, self.file_uploader,
+                           unresolved_images=self.unresolved_images).prepare_db_data()
 
-        for _ in range(iter_times):
-            with DBSessionManager(self.engine) as current_session:
-                news_service = NewsContentService(current_session)
-                news_contents = news_service.get_news_contents(BATCH_SIZE)
+        with DBSessionManager(self.engine) as current_session:
+            MigrationProgressService(current_session).finish_stage(self.PREPARE_STAGE)
+
+    def _load_assets_index(self, engine=None):
+        if self.assets_index.is_loaded:
+            return
+
+        with DBSessionManager(engine or self.engine) as current_session:
+            self.assets_index.load(current_session)
+
+    def modify_db_data_for_entities(self, engine, start_news_content_id, end_news_content_id,
+                                    resume=settings.MIGRATION_RESUME) -> int:
+        stage = f'{self.MODIFY_STAGE}:{start_news_content_id}-{end_news_content_id}'
+        self.metrics.instrument_engine(engine)
+        self._prepare_progress(engine, resume, stage)
+        self._load_assets_index(engine)
+
+        try:
+            with MetricsReporter(self.metrics):
+                return self._modify_db_data(engine, start_news_content_id, end_news_content_id, stage)
+        finally:
+            self.report_unresolved_images(report_path=None)
+            self._close_executors()
+
+    def _modify_db_data(self, engine=None, start_news_content_id=None, end_news_content_id=None,
+                        stage=MODIFY_STAGE) -> int:
+        engine = engine or self.engine
+        news_contents_count = 0
+
+        with DBSessionManager(engine) as current_session:
+            progress = MigrationProgressService(current_session).get_progress(stage)
+            if progress and progress.is_finished:
+                logging.info(f'Stage {stage} is already finished, skipping it.')
+                return news_contents_count
+
+            last_news_content_id = progress.last_news_content_id if progress else None
+
+        if self.pipeline:
+            news_contents_count = self._modify_db_data_pipelined(engine, start_news_content_id, end_news_content_id,
+                                                                 last_news_content_id, stage)
+
+        else:
+            for news_contents, current_session in self._iter_news_content_batches(
+                    engine, start_news_content_id, end_news_content_id, last_news_content_id):
+                MigrationProgressService(current_session).save_batch(
+                    stage, news_contents[-1].news_content_id, len(news_contents))
                 self._modify_db_data_partial(news_contents, current_session)
+                news_contents_count += len(news_contents)
+
+        with DBSessionManager(engine) as current_session:
+            MigrationProgressService(current_session).finish_stage(stage)
+
+        return news_contents_count
+
+    def _iter_news_content_batches(self, engine=None, start_news_content_id=None, end_news_content_id=None,
+                                   last_news_content_id=None, hold_session=True):
+        """
+        Keyset pagination over news_content: every batch is selected by 'news_content_id < last seen id',
+        so each row is read exactly once and only one batch is kept in memory (one session per batch).
+        The batches are lists of NewsContentText tuples.
+
+        With hold_session every batch is yielded with its open session, in which it is changed and committed;
+        without it the session is closed before the batch is yielded (with None instead of the session), so
+        a consumer which waits, e.g. the pipeline read stage on a full queue, does not hold a DB connection.
+        """
+        if last_news_content_id is None and end_news_content_id is not None:
+            last_news_content_id = end_news_content_id + 1
+
+        while True:
+            with DBSessionManager(engine or self.engine) as current_session:
+                news_contents = NewsContentService(current_session).get_news_content_texts_page(
+                    last_news_content_id, self.batch_size, start_news_content_id)
+                if not news_contents:
+                    break
+
+                last_news_content_id = news_contents[-1].news_content_id
+                if hold_session:
+                    yield news_contents, current_session
+                    continue
+
+            yield news_contents, None
+
+    def _modify_db_data_pipelined(self, engine, start_news_content_id, end_news_content_id, last_news_content_id,
+                                  stage) -> int:
+        """
+        The batches go through the read -> parse -> upload -> write stages, each one running in its own thread
+        (parsing in the parse process pool, uploads in the upload pool) on a different batch at the same time,
+        so the throughput is bounded by the slowest stage instead of the sum of all of them. The stages are
+        connected by bounded queues: when writing is slow, reading, parsing and uploading wait for it.
+        The batches are written in the order they are read, each one with its checkpoint.
+        """
+        pending_uploads = {}
+        pipeline = StagedPipeline([
+            ('parse', self._parse_batch),
+            ('upload', partial(self._upload_batch, pending_uploads)),
+        ], metrics=self.metrics)
+        news_content_batches = self._iter_news_content_batches_with_links(
+            engine, start_news_content_id, end_news_content_id, last_news_content_id)
+        news_contents_count = 0
+
+        for parsed_htmls, existing_links, uploads in pipeline.run(news_content_batches, 'read'):
+            with self.metrics.measure('pipeline:write'), DBSessionManager(engine) as current_session:
+                MigrationProgressService(current_session).save_batch(
+                    stage, parsed_htmls[-1].news_content_id, len(parsed_htmls))
+                self._write_parsed_batch(parsed_htmls, existing_links, uploads, current_session)
+            news_contents_count += len(parsed_htmls)
+
+            for file_name, future in uploads.items():
+                if pending_uploads.get(file_name) is future:
+                    del pending_uploads[file_name]
+
+        return news_contents_count
+
+    def _iter_news_content_batches_with_links(self, engine, start_news_content_id, end_news_content_id,
+                                              last_news_content_id):
+        """
+        The read stage: every batch comes with the news_content_assets links its articles already have, so the
+        upload stage skips the articles which are linked (e.g. by the interrupted run) like the writer does.
+        """
+        for news_contents, _ in self._iter_news_content_batches(engine, start_news_content_id, end_news_content_id,
+                                                                last_news_content_id, hold_session=False):
+            with DBSessionManager(engine) as current_session:
+                existing_links = NewsContentAssetsWriter(current_session).load_existing_links(
+                    news_content.news_content_id for news_content in news_contents).existing_links
+            yield news_contents, existing_links
+
+    def _parse_batch(self, news_contents_with_links):
+        news_contents, existing_links = news_contents_with_links
+        parsed_htmls = list(self.parse_service.iter_parse(
+            (news_content.news_content_id, news_content.text) for news_content in news_contents))
+        return parsed_htmls, existing_links
+
+    def _upload_batch(self, pending_uploads, parsed_htmls_with_links):
+        """
+        Starts the uploads of the batch images which have no asset yet. An image is uploaded once even if it
+        appears in several batches: pending_uploads keeps the futures until the writer has consumed them (the
+        later batches find the created asset in the index then), whatever key the upload has got.
+        The images of the articles which already have links are not uploaded, the writer does not link them.
+        """
+        parsed_htmls, existing_links = parsed_htmls_with_links
+        linked_news_content_ids = {news_content_id for news_content_id, _ in existing_links}
+        uploads = {}
+        for parsed_html in parsed_htmls:
+            if parsed_html.news_content_id in linked_news_content_ids:
+                continue
+
+            for image_path in filter(None, parsed_html.image_urls):
+                file_name = FileUploader.get_file_name_by_path(image_path)
+                if file_name in uploads or file_name in self.assets_index or not self.file_uploader.is_resolved(
+                        image_path):
+                    continue
+
+                # the writer thread removes the consumed futures, so the entry is read once
+                future = pending_uploads.get(file_name)
+                if future is None:
+                    future = pending_uploads[file_name] = self.upload_pool.submit_file_from_path(image_path)
+                uploads[file_name] = future
+
+        return parsed_htmls, existing_links, uploads
+
+    def _write_parsed_batch(self, parsed_htmls, existing_links, uploads, current_session):
+        links_writer = NewsContentAssetsWriter(current_session).add_existing_links(existing_links)
+        new_assets_links = []
+
+        for parsed_html in parsed_htmls:
+            if not links_writer.has_links(parsed_html.news_content_id):
+                with self.metrics.measure('asset_lookup'):
+                    self._extract_image_urls_into_assets(parsed_html.news_content_id, parsed_html.image_urls,
+                                                         links_writer, uploads, new_assets_links)
+
+        self._create_uploaded_assets(uploads, new_assets_links, current_session, links_writer)
+
+        with self.metrics.measure('insert'):
+            links_writer.flush()
+            NewsContentService(current_session).update_news_content_texts(
+                NewsContentText(parsed_html.news_content_id, parsed_html.text) for parsed_html in parsed_htmls)
+            self._write_youtube_urls(parsed_htmls, current_session)
+
+        with self.metrics.measure('commit'):
+            current_session.commit()
 
-                current_session.commit()
+        self.metrics.increment(MigrationMetrics.NEWS_CONTENTS_COUNTER, len(parsed_htmls))
+        self.metrics.increment('batches')
 
     def _modify_db_data_partial(self, news_contents, current_session):
-        for news_content in news_contents:
-            parse_service = ParseTextFromHtmlService(news_content.text)
-            news_content.text = parse_service.parse_text()
-
-            if not news_content.assets:
-                image_urls = parse_service.parse_image_urls()
-                self._extract_image_urls_into_assets(news_content, image_urls, current_session)
+        """
+        The images of the batch which have no asset yet are uploaded in the background while the rest of the batch
+        is being parsed; the new assets and all the links are written at the end of the batch.
+        """
+        links_writer = NewsContentAssetsWriter(current_session).load_existing_links(
+            news_content.news_content_id for news_content in news_contents)
+        news_content_texts = []
+        youtube_parsed_htmls = []
+        uploads = {}
+        new_assets_links = []
+
+        parsed_htmls = self.metrics.measure_iter('parse', self.parse_service.iter_parse(
+            (news_content.news_content_id, news_content.text) for news_content in news_contents))
+
+        for parsed_html in parsed_htmls:
+            news_content_texts.append(NewsContentText(parsed_html.news_content_id, parsed_html.text))
+            if parsed_html.youtube_urls:
+                youtube_parsed_htmls.append(parsed_html)
+
+            if not links_writer.has_links(parsed_html.news_content_id):
+                with self.metrics.measure('asset_lookup'):
+                    self._extract_image_urls_into_assets(parsed_html.news_content_id, parsed_html.image_urls,
+                                                         links_writer, uploads, new_assets_links)
+
+        self._create_uploaded_assets(uploads, new_assets_links, current_session, links_writer)
+        with self.metrics.measure('insert'):
+            links_writer.flush()
+            NewsContentService(current_session).update_news_content_texts(news_content_texts)
+            self._write_youtube_urls(youtube_parsed_htmls, current_session)
+
+        with self.metrics.measure('commit'):
+            current_session.commit()
 
-            news_content.updated_date = datetime.utcnow()
-        current_session.commit()
+        self.metrics.increment(MigrationMetrics.NEWS_CONTENTS_COUNTER, len(news_contents))
+        self.metrics.increment('batches')
 
-    def _extract_image_urls_into_assets(self, news_content, image_urls, current_session):
-        for image_path in image_urls:
+    @staticmethod
+    def _write_youtube_urls(parsed_htmls, current_session):
+        """
+        The youtube urls are taken from the same parse result as the text, so an article is parsed once for both.
+        view_data is already cleaned by the prepare stage, it is only set for the articles with youtube urls.
+        """
+        NewsContentService(current_session).update_news_content_youtube_urls(
+            {parsed_html.news_content_id: parsed_html.youtube_urls
+             for parsed_html in parsed_htmls if parsed_html.youtube_urls})
+
+    def _extract_image_urls_into_assets(self, news_content_id, image_urls, links_writer, uploads, new_assets_links):
+        for image_path in filter(None, image_urls):
             file_name = FileUploader.get_file_name_by_path(image_path)
-            asset_service = AssetsService(current_session)
-            asset = asset_service.get_asset_by_file_name(file_name)
+            asset_id = self.assets_index.get_asset_id(file_name)
+
+            if asset_id is not None:
+                links_writer.add(news_content_id, asset_id)
+                continue
+
+            if not self.file_uploader.is_resolved(image_path):
+                self.unresolved_images.setdefault(image_path, []).append(news_content_id)
+                continue
+
+            if file_name not in uploads:
+                uploads[file_name] = self.upload_pool.submit_file_from_path(image_path)
+            new_assets_links.append((news_content_id, file_name))
+
+    def _create_uploaded_assets(self, uploads, new_assets_links, current_session, links_writer):
+        with self.metrics.measure('upload_wait'):
+            uploaded_file_names = {file_name: future.result() for file_name, future in uploads.items()}
 
-            current_session.refresh(news_content)
+        new_file_names = list(dict.fromkeys(
+            uploaded_file_name for uploaded_file_name in uploaded_file_names.values()
+            if uploaded_file_name and uploaded_file_name not in self.assets_index))
+        with self.metrics.measure('insert'):
+            asset_ids = AssetsService(current_session).create_assets(new_file_names)
 
-            if asset is None:
-                file_name = FileUploader().upload_file_from_path(image_path)
-                if file_name:
-                    asset_service.create_asset_with_reference(news_content.news_content_id, file_name)
+        for file_name, asset_id in zip(new_file_names, asset_ids):
+            self.assets_index.add(file_name, asset_id)
 
-            elif asset and asset not in news_content.assets:
-                asset_service.create_reference_between_news_and_assets(
-                    news_content.news_content_id, asset.asset_id)
+        for news_content_id, file_name in new_assets_links:
+            uploaded_file_name = uploaded_file_names[file_name]
+            if uploaded_file_name:
+                links_writer.add(news_content_id, self.assets_index.get_asset_id(uploaded_file_name))
@@ -1,6 +1,12 @@
+import asyncio
+import itertools
 import logging
-from abc import ABC
-from typing import Optional, Dict
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Dict, List
 from urllib.parse import unquote
 
 import boto3
@@ -9,9 +15,15 @@ from requests import Timeout, ConnectTimeout
 
 import settings
 
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from io import BytesIO
 
+from services.image_index import LocalImageIndex, get_shared_image_index
+from services.image_optimizer import ImageOptimizer, get_shared_image_optimizer
+from services.metrics import MigrationMetrics, get_shared_migration_metrics
+from services.upload_manifest import UploadManifest, get_file_content_hash
 from utils import stored_property
 
 
@@ -56,12 +68,13 @@ class AWSClient(ABC):
     """
     service_name: str = NotImplementedError
 
-    def __init__(self, session: Optional[boto3.session.Session] = None):
+    def __init__(self, session: Optional[boto3.session.Session] = None, config: Optional[Config] = None):
         self.aws_session = session or AWSSessionCreator().create_aws_session_for_service(self.service_name)
+        self.config = config
 
     @stored_property
     def service_client(self):
-        return self.aws_session.client(self.service_name)
+        return self.aws_session.client(self.service_name, config=self.config)
 
 
 class AWSClientWithResource(AWSClient):
@@ -74,7 +87,7 @@ class AWSClientWithResource(AWSClient):
 
     @stored_property
     def service_resource(self):
-        return self.aws_session.resource(self.service_name)
+        return self.aws_session.resource(self.service_name, config=self.config)
 
 
 class S3Client(AWSClientWithResource):
@@ -91,10 +104,31 @@ class S3Client(AWSClientWithResource):
         s3_items = bucket.objects.filter(Prefix=key_prefix)
         return [s3_item.key for s3_item in s3_items]
 
+    def get_objects_etags(self, bucket_name, key_prefix) -> Dict[str, str]:
+        bucket = self._get_bucket(bucket_name)
+        s3_items = bucket.objects.filter(Prefix=key_prefix)
+        return {s3_item.key: s3_item.e_tag.strip('"') for s3_item in s3_items}
+
     def upload_body_data(self, bucket_name, key, body, **kwargs):
         bucket = self._get_bucket(bucket_name)
         return bucket.put_object(Key=key, Body=body, **kwargs)
 
+    def put_object(self, bucket_name, key, body, **kwargs):
+        """
+        The same as 'upload_body_data', but through the low-level client, which (unlike the resource)
+        is safe to share between threads.
+        """
+        return self.service_client.put_object(Bucket=bucket_name, Key=key, Body=body, **kwargs)
+
+    def upload_fileobj(self, bucket_name, key, fileobj, transfer_config: Optional[TransferConfig] = None, **kwargs):
+        """
+        Streams the file object with a managed transfer: files above the transfer config threshold are sent as
+        a multipart upload (parallel parts, a failed part is retried alone), reading no more than
+        'multipart_chunksize * max_concurrency' bytes into memory at a time.
+        """
+        return self.service_client.upload_fileobj(fileobj, bucket_name, key, ExtraArgs=kwargs or None,
+                                                  Config=transfer_config)
+
     def delete_objects(self, bucket_name, keys_to_delete):
         objects_to_delete = [{'Key': key} for key in keys_to_delete]
         bucket = self._get_bucket(bucket_name)
@@ -124,10 +158,180 @@ class S3Client(AWSClientWithResource):
         return file_data
 
 
+def create_default_transfer_config() -> TransferConfig:
+    return TransferConfig(
+        multipart_threshold=settings.MULTIPART_UPLOAD_THRESHOLD,
+        multipart_chunksize=settings.MULTIPART_UPLOAD_PART_SIZE,
+        max_concurrency=settings.MULTIPART_UPLOAD_CONCURRENCY,
+    )
+
+
+def get_file_size(fileobj) -> int:
+    size = fileobj.seek(0, os.SEEK_END)
+    fileobj.seek(0)
+    return size
+
+
+class StorageBackend(ABC):
+    """
+    A storage the files are uploaded to. Every backend offers the blocking 'upload_file' and the asyncio-friendly
+    'upload_file_async'; by default the latter runs the blocking upload in a worker thread.
+    """
+
+    @abstractmethod
+    def upload_file(self, key, fileobj, **kwargs):
+        pass
+
+    async def upload_file_async(self, key, fileobj, **kwargs):
+        return await asyncio.to_thread(self.upload_file, key, fileobj, **kwargs)
+
+    @abstractmethod
+    def get_objects(self, key_prefix) -> List[str]:
+        pass
+
+    @abstractmethod
+    def get_objects_etags(self, key_prefix) -> Dict[str, str]:
+        pass
+
+
+class S3StorageBackend(StorageBackend):
+
+    def __init__(self, s3_client: Optional[S3Client] = None, bucket_name: str = settings.FILE_UPLOAD_BUCKET_NAME,
+                 transfer_config: Optional[TransferConfig] = None):
+        self.s3_client = s3_client or S3Client()
+        self.bucket_name = bucket_name
+        self.transfer_config = transfer_config or create_default_transfer_config()
+
+    def upload_file(self, key, fileobj, **kwargs):
+        """
+        Files smaller than the multipart threshold are sent with one PUT, the bigger ones (video, high-res
+        galleries) are streamed as a multipart upload.
+        """
+        if get_file_size(fileobj) >= self.transfer_config.multipart_threshold:
+            return self.s3_client.upload_fileobj(self.bucket_name, key, fileobj, self.transfer_config, **kwargs)
+
+        return self.s3_client.put_object(self.bucket_name, key, fileobj, **kwargs)
+
+    def get_objects(self, key_prefix) -> List[str]:
+        return self.s3_client.get_objects(self.bucket_name, key_prefix)
+
+    def get_objects_etags(self, key_prefix) -> Dict[str, str]:
+        return self.s3_client.get_objects_etags(self.bucket_name, key_prefix)
+
+
+class LocalStorageBackend(StorageBackend):
+    """
+    Stores the files in a local directory with the bucket semantics: the key is the relative path, an upload
+    overwrites the object, the ETag is the MD5 of the content. The optional latency (seconds per request) and
+    bandwidth (bytes per second) imitate the network, so upload concurrency can be tuned without the real bucket.
+    """
+    CHUNK_SIZE = 64 * 1024
+    TMP_SUFFIX = '.uploading'
+
+    def __init__(self, root_path: str = settings.LOCAL_STORAGE_PATH, latency: float = settings.LOCAL_STORAGE_LATENCY,
+                 bandwidth: Optional[int] = settings.LOCAL_STORAGE_BANDWIDTH):
+        self.root_path = root_path
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.objects_metadata = {}
+        self._upload_ids = itertools.count()
+
+    def upload_file(self, key, fileobj, **kwargs):
+        time.sleep(self.latency)
+
+        tmp_object_path = self._get_tmp_object_path(key)
+        try:
+            with open(tmp_object_path, 'wb') as object_file:
+                for chunk in iter(lambda: fileobj.read(self.CHUNK_SIZE), b''):
+                    object_file.write(chunk)
+                    time.sleep(self._get_transfer_time(chunk))
+
+            return self._save_object(key, tmp_object_path, **kwargs)
+        finally:
+            self._remove_tmp_object(tmp_object_path)
+
+    async def upload_file_async(self, key, fileobj, **kwargs):
+        """
+        The file operations are blocking, they are run in the default executor so the event loop keeps serving
+        the other uploads.
+        """
+        await asyncio.sleep(self.latency)
+
+        tmp_object_path = await asyncio.to_thread(self._get_tmp_object_path, key)
+        try:
+            object_file = await asyncio.to_thread(open, tmp_object_path, 'wb')
+            with object_file:
+                while chunk := await asyncio.to_thread(fileobj.read, self.CHUNK_SIZE):
+                    await asyncio.to_thread(object_file.write, chunk)
+                    await asyncio.sleep(self._get_transfer_time(chunk))
+
+            return await asyncio.to_thread(self._save_object, key, tmp_object_path, **kwargs)
+        finally:
+            await asyncio.to_thread(self._remove_tmp_object, tmp_object_path)
+
+    def get_objects(self, key_prefix) -> List[str]:
+        keys = []
+        for dir_path, _, file_names in os.walk(self.root_path):
+            for file_name in file_names:
+                key = os.path.relpath(os.path.join(dir_path, file_name), self.root_path).replace(os.sep, '/')
+                if key.startswith(key_prefix) and not key.endswith(self.TMP_SUFFIX):
+                    keys.append(key)
+        return sorted(keys)
+
+    def get_objects_etags(self, key_prefix) -> Dict[str, str]:
+        return {key: get_file_content_hash(self.get_object_path(key)) for key in self.get_objects(key_prefix)}
+
+    def get_object_path(self, key) -> str:
+        return os.path.join(self.root_path, *key.split('/'))
+
+    def _get_tmp_object_path(self, key) -> str:
+        """
+        Every upload writes its own tmp file, so the concurrent uploads of the same key do not mix their content;
+        the last one to finish replaces the object.
+        """
+        object_path = self.get_object_path(key)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        return f'{object_path}.{os.getpid()}.{threading.get_ident()}.{next(self._upload_ids)}{self.TMP_SUFFIX}'
+
+    def _save_object(self, key, tmp_object_path, **kwargs) -> dict:
+        object_path = self.get_object_path(key)
+        os.replace(tmp_object_path, object_path)
+        self.objects_metadata[key] = kwargs
+        return {'ETag': f'"{get_file_content_hash(object_path)}"'}
+
+    @staticmethod
+    def _remove_tmp_object(tmp_object_path):
+        if os.path.exists(tmp_object_path):
+            os.remove(tmp_object_path)
+
+    def _get_transfer_time(self, chunk) -> float:
+        return len(chunk) / self.bandwidth if self.bandwidth else 0
+
+
+STORAGE_BACKENDS = {
+    's3': S3StorageBackend,
+    'local': LocalStorageBackend,
+}
+
+
+def create_default_storage_backend() -> StorageBackend:
+    """
+    The backend chosen by settings.FILE_STORAGE_BACKEND. The S3 client connection pool is sized for
+    settings.UPLOAD_WORKERS concurrent uploads, each of which may send MULTIPART_UPLOAD_CONCURRENCY parts at once.
+    """
+    if settings.FILE_STORAGE_BACKEND == 's3':
+        max_pool_connections = max(settings.UPLOAD_WORKERS, 1) * settings.MULTIPART_UPLOAD_CONCURRENCY
+        s3_client = S3Client(config=Config(max_pool_connections=max_pool_connections))
+        s3_client.service_client  # the client is created once here, not concurrently by the upload threads
+        return S3StorageBackend(s3_client)
+
+    return STORAGE_BACKENDS[settings.FILE_STORAGE_BACKEND]()
+
+
 class FileUploadBase:
 
-    def __init__(self):
-        self._s3_client = S3Client()
+    def __init__(self, storage_backend: Optional[StorageBackend] = None):
+        self.storage_backend = storage_backend or create_default_storage_backend()
 
     @property
     def bucket_name(self):
@@ -138,7 +342,11 @@ class FileUploadProcessor(FileUploadBase):
 
     def upload_file(self, key, fileobj, **kwargs):
         kwargs.update(self._set_content_type_if_needed(fileobj))
-        return self._s3_client.upload_body_data(self.bucket_name, key, fileobj, **kwargs)
+        return self.storage_backend.upload_file(key, fileobj, **kwargs)
+
+    async def upload_file_async(self, key, fileobj, **kwargs):
+        kwargs.update(self._set_content_type_if_needed(fileobj))
+        return await self.storage_backend.upload_file_async(key, fileobj, **kwargs)
 
     def _set_content_type_if_needed(self, fileobj) -> dict:
         mime_service = magic.Magic(mime=True, uncompress=True)
@@ -151,18 +359,116 @@ class FileUploadProcessor(FileUploadBase):
         return {}
 
 
+_shared_file_upload_processor: Optional[FileUploadProcessor] = None
+_shared_file_upload_processor_pid: Optional[int] = None
+_shared_file_upload_processor_lock = threading.Lock()
+
+
+def get_shared_file_upload_processor() -> FileUploadProcessor:
+    """
+    One FileUploadProcessor (for S3: one boto3 session, client and HTTP connection pool) for the whole process.
+    A forked process (e.g. a shard) creates its own instead of reusing the sockets of the parent.
+    """
+    global _shared_file_upload_processor, _shared_file_upload_processor_pid
+
+    with _shared_file_upload_processor_lock:
+        if _shared_file_upload_processor is None or _shared_file_upload_processor_pid != os.getpid():
+            _shared_file_upload_processor = FileUploadProcessor()
+            _shared_file_upload_processor_pid = os.getpid()
+
+    return _shared_file_upload_processor
+
+
+_shared_upload_manifest: Optional[UploadManifest] = None
+_shared_upload_manifest_pid: Optional[int] = None
+_shared_upload_manifest_lock = threading.Lock()
+
+
+def get_shared_upload_manifest() -> Optional[UploadManifest]:
+    """
+    The upload manifest configured by settings.UPLOAD_MANIFEST_PATH (None if it is not set). On the first use it is
+    seeded from the stored objects under settings.UPLOAD_MANIFEST_SEED_PREFIX, if that is set.
+    Every process opens its own connection to the manifest file, an SQLite connection must not cross a fork.
+    """
+    global _shared_upload_manifest, _shared_upload_manifest_pid
+
+    if not settings.UPLOAD_MANIFEST_PATH:
+        return None
+
+    with _shared_upload_manifest_lock:
+        if _shared_upload_manifest is None or _shared_upload_manifest_pid != os.getpid():
+            _shared_upload_manifest = UploadManifest(settings.UPLOAD_MANIFEST_PATH)
+            _shared_upload_manifest_pid = os.getpid()
+
+            if settings.UPLOAD_MANIFEST_SEED_PREFIX is not None:
+                _shared_upload_manifest.seed_from_storage(get_shared_file_upload_processor().storage_backend,
+                                                          settings.UPLOAD_MANIFEST_SEED_PREFIX)
+
+    return _shared_upload_manifest
+
+
 class FileUploader:
+    def __init__(self, upload_manifest: Optional[UploadManifest] = None,
+                 file_upload_processor: Optional[FileUploadProcessor] = None,
+                 metrics: Optional[MigrationMetrics] = None, image_index: Optional[LocalImageIndex] = None,
+                 image_optimizer: Optional[ImageOptimizer] = None):
+        self.upload_manifest = upload_manifest if upload_manifest is not None else get_shared_upload_manifest()
+        self._file_upload_processor = file_upload_processor
+        self.metrics = metrics or get_shared_migration_metrics()
+        self.image_index = image_index if image_index is not None else get_shared_image_index()
+        self.image_optimizer = image_optimizer if image_optimizer is not None else get_shared_image_optimizer()
+
+    @property
+    def file_upload_processor(self) -> FileUploadProcessor:
+        return self._file_upload_processor or get_shared_file_upload_processor()
+
     def upload_file(self, fileobj, key):
-        file_upload_processor = FileUploadProcessor()
-        return file_upload_processor.upload_file(key, fileobj)
+        return self.file_upload_processor.upload_file(key, fileobj)
+
+    async def upload_file_async(self, fileobj, key):
+        return await self.file_upload_processor.upload_file_async(key, fileobj)
 
     def upload_file_from_path(self, file_path) -> str:
+        """
+        Returns the key of the uploaded file. If the upload manifest is used and a file with the same content
+        has already been uploaded, nothing is uploaded and the key of that file is returned.
+        With the image index the path is resolved to the actual file (case and percent-encoding insensitive),
+        the key is still the file name from the path.
+        With the image optimizer the optimized copy of the image is uploaded under the same key, so the assets
+        stay keyed by the file names the articles refer to; a WebP copy only gets the image/webp ContentType.
+        """
         file_name = self.get_file_name_by_path(file_path)
 
+        if self.image_index is not None:
+            resolved_file_path = self.image_index.get_file_path(file_path)
+            if resolved_file_path is None:
+                logger.error(f'File is not found in the image index: {file_path}')
+                self.metrics.increment('missing_files')
+                return ''
+            file_path = resolved_file_path
+
         try:
+            content_hash = (get_file_content_hash(file_path)
+                            if self.upload_manifest is not None or self.image_optimizer is not None else None)
+            if content_hash and self.upload_manifest is not None:
+                uploaded_file_name = self.upload_manifest.get_key(content_hash)
+                if uploaded_file_name:
+                    logger.info(f'File {file_path} is already uploaded as {uploaded_file_name}.')
+                    self.metrics.increment('deduplicated_uploads')
+                    return uploaded_file_name
+
+            if self.image_optimizer is not None:
+                file_path = self._optimize_image(file_path, content_hash)
+
             with open(file_path, "rb") as fileobj:
-                self.upload_file(fileobj, file_name)
-                return file_name
+                with self.metrics.measure('upload'):
+                    self.upload_file(fileobj, file_name)
+                self.metrics.increment('uploaded_files')
+                self.metrics.increment('uploaded_bytes', os.fstat(fileobj.fileno()).st_size)
+
+            if content_hash and self.upload_manifest is not None:
+                self.upload_manifest.add(content_hash, file_name)
+            return file_name
 
         except (Timeout, ConnectTimeout, ConnectionError) as e:
             logger.error(f'Upload file error: {e}')
@@ -170,8 +476,79 @@ class FileUploader:
 
         except FileNotFoundError as e:
             logger.error(f'File is not found: {e}')
+            self.metrics.increment('missing_files')
             return ''
 
+    def is_resolved(self, file_path) -> bool:
+        """
+        False if the file is not found in the image index; without the index the path is always tried as it is.
+        """
+        return self.image_index is None or self.image_index.resolve(file_path) is not None
+
+    def _optimize_image(self, file_path, content_hash) -> str:
+        with self.metrics.measure('image_optimization'):
+            optimized_image = self.image_optimizer.optimize(file_path, content_hash)
+
+        if optimized_image.file_path != file_path:
+            self.metrics.increment('image_optimization_saved_bytes',
+                                   os.path.getsize(file_path) - os.path.getsize(optimized_image.file_path))
+
+        return optimized_image.file_path
+
     @staticmethod
     def get_file_name_by_path(path):
         return unquote(path.split('/')[-1])
+
+
+class FileUploadPool:
+    """
+    Uploads files in a bounded thread pool sharing one S3 client. Every job returns a future resolving to the
+    uploaded key ('' if the upload has failed). When 'max_pending' jobs are queued, 'submit' blocks until one
+    of them is done, so a slow network throttles the producer instead of growing the queue.
+    With max_workers=0 the files are uploaded synchronously in the calling thread.
+    """
+    def __init__(self, max_workers: int = settings.UPLOAD_WORKERS, max_pending: Optional[int] = None,
+                 file_uploader: Optional[FileUploader] = None):
+        self.max_workers = max_workers
+        self.file_uploader = file_uploader or FileUploader()
+        self._pending_semaphore = threading.BoundedSemaphore(max_pending or max(max_workers, 1) * 4)
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit_file_from_path(self, file_path) -> Future:
+        return self._submit(self.file_uploader.upload_file_from_path, file_path)
+
+    def submit_file(self, fileobj, key) -> Future:
+        return self._submit(self.file_uploader.upload_file, fileobj, key)
+
+    def _submit(self, upload_method, *args) -> Future:
+        if not self.max_workers:
+            future = Future()
+            future.set_result(upload_method(*args))
+            return future
+
+        self._pending_semaphore.acquire()
+        try:
+            future = self.executor.submit(upload_method, *args)
+        except Exception:
+            self._pending_semaphore.release()
+            raise
+
+        future.add_done_callback(lambda _: self._pending_semaphore.release())
+        return future
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='file-upload')
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,116 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import NamedTuple, Dict, List, Optional, Iterable
+from urllib.parse import unquote
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImageFileInfo(NamedTuple):
+    path: str
+    size: int
+    mtime: float
+
+
+class LocalImageIndex:
+    """
+    Index of the files under root_path (the directory the image paths of the articles are relative to) built with
+    one parallel os.scandir walk, so resolving an image path is a dict lookup instead of a file system call.
+
+    The files are keyed by the normalized relative path (percent-decoded, '/' separated, case-folded) and by the
+    normalized base name; a path which is not found as it is falls back to the base name if only one file has it.
+    """
+    def __init__(self, root_path: str = settings.IMAGES_ROOT_PATH or '.',
+                 max_workers: int = settings.IMAGE_INDEX_WORKERS):
+        self.root_path = root_path
+        self.max_workers = max_workers
+        self.files_by_path: Dict[str, ImageFileInfo] = {}
+        self.files_by_base_name: Dict[str, List[ImageFileInfo]] = {}
+
+    def __len__(self):
+        return len(self.files_by_path)
+
+    @staticmethod
+    def normalize_path(path: str) -> str:
+        path = unquote(path).replace('\\', '/')
+        while path.startswith(('./', '/')):
+            path = path[1:] if path.startswith('/') else path[2:]
+        return path.casefold()
+
+    def scan(self):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {executor.submit(self._scan_dir, '')}
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, dir_paths = future.result()
+                    for file_info in files:
+                        self.add(file_info)
+                    pending.update(executor.submit(self._scan_dir, dir_path) for dir_path in dir_paths)
+
+        logger.info(f'{len(self)} files are found in {self.root_path}.')
+        return self
+
+    def _scan_dir(self, relative_dir_path):
+        files = []
+        dir_paths = []
+
+        with os.scandir(os.path.join(self.root_path, relative_dir_path)) as dir_entries:
+            for dir_entry in dir_entries:
+                relative_path = f'{relative_dir_path}/{dir_entry.name}' if relative_dir_path else dir_entry.name
+                if dir_entry.is_dir(follow_symlinks=False):
+                    dir_paths.append(relative_path)
+                elif dir_entry.is_file():
+                    stat = dir_entry.stat()
+                    files.append(ImageFileInfo(relative_path, stat.st_size, stat.st_mtime))
+
+        return files, dir_paths
+
+    def add(self, file_info: ImageFileInfo):
+        normalized_path = self.normalize_path(file_info.path)
+        self.files_by_path[normalized_path] = file_info
+        self.files_by_base_name.setdefault(normalized_path.rsplit('/', 1)[-1], []).append(file_info)
+
+    def resolve(self, image_path: str) -> Optional[ImageFileInfo]:
+        normalized_path = self.normalize_path(image_path)
+        file_info = self.files_by_path.get(normalized_path)
+        if file_info is not None:
+            return file_info
+
+        files = self.files_by_base_name.get(normalized_path.rsplit('/', 1)[-1], ())
+        return files[0] if len(files) == 1 else None
+
+    def get_file_path(self, image_path: str) -> Optional[str]:
+        file_info = self.resolve(image_path)
+        return os.path.join(self.root_path, *file_info.path.split('/')) if file_info else None
+
+    def find_unresolved(self, image_paths: Iterable[str]) -> List[str]:
+        return [image_path for image_path in dict.fromkeys(image_paths) if self.resolve(image_path) is None]
+
+
+_shared_image_index: Optional[LocalImageIndex] = None
+_shared_image_index_pid: Optional[int] = None
+_shared_image_index_lock = threading.Lock()
+
+
+def get_shared_image_index() -> Optional[LocalImageIndex]:
+    """
+    The index of settings.IMAGES_ROOT_PATH (None if it is not set), scanned once per process.
+    """
+    global _shared_image_index, _shared_image_index_pid
+
+    if not settings.IMAGES_ROOT_PATH:
+        return None
+
+    with _shared_image_index_lock:
+        if _shared_image_index is None or _shared_image_index_pid != os.getpid():
+            _shared_image_index = LocalImageIndex(settings.IMAGES_ROOT_PATH).scan()
+            _shared_image_index_pid = os.getpid()
+
+    return _shared_image_index
@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, Optional
+
+import settings
+from services.upload_manifest import get_file_content_hash
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    # Pillow is needed only for the optional image optimization
+    Image = ImageOps = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImageOptimizationOptions(NamedTuple):
+    max_dimension: int = settings.IMAGE_MAX_DIMENSION
+    quality: int = settings.IMAGE_QUALITY
+    webp: bool = settings.IMAGE_WEBP
+    strip_metadata: bool = settings.IMAGE_STRIP_METADATA
+
+    @property
+    def key(self) -> str:
+        return f'{self.max_dimension}_{self.quality}_{"webp" if self.webp else "same"}_{int(self.strip_metadata)}'
+
+
+class OptimizedImage(NamedTuple):
+    file_path: str
+
+
+OPTIMIZED_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+
+def optimize_image(source_path: str, target_path: str, options: ImageOptimizationOptions) -> bool:
+    """
+    Writes the optimized copy of the image to target_path: rotated by its EXIF orientation, scaled down to fit into
+    max_dimension, recompressed (as WebP if options.webp), without EXIF and ICC profile if options.strip_metadata.
+    Returns False (and writes nothing) for the formats which are not optimized (e.g. animated GIF) and when the
+    result is not smaller than the source.
+    """
+    with Image.open(source_path) as source_image:
+        source_format = source_image.format
+        if source_format not in OPTIMIZED_FORMATS or getattr(source_image, 'is_animated', False):
+            return False
+
+        image = ImageOps.exif_transpose(source_image)
+        is_resized = max(image.size) > options.max_dimension
+        image.thumbnail((options.max_dimension, options.max_dimension), Image.LANCZOS)
+
+    output_format = 'WEBP' if options.webp else source_format
+    save_options = {}
+
+    if output_format == 'JPEG':
+        image = image.convert('RGB') if image.mode not in ('RGB', 'L') else image
+        save_options.update(quality=options.quality, optimize=True, progressive=True)
+    elif output_format == 'PNG':
+        save_options.update(optimize=True)
+    else:
+        save_options.update(quality=options.quality, method=4)
+
+    if not options.strip_metadata:
+        save_options.update({name: image.info[name] for name in ('exif', 'icc_profile') if image.info.get(name)})
+
+    image.save(target_path, output_format, **save_options)
+
+    if output_format == source_format and not is_resized and os.path.getsize(target_path) >= os.path.getsize(
+            source_path):
+        os.remove(target_path)
+        return False
+
+    return True
+
+
+class ImageOptimizer:
+    """
+    Optimizes the images before upload (see optimize_image) in a process pool; with max_workers=0 in the calling
+    thread. The results are cached in cache_path by the content hash of the source and the options, so a rerun
+    re-encodes nothing: the cached file is uploaded, or the source if it could not be made smaller (or could not be
+    read at all, e.g. a truncated file or a decompression bomb).
+    """
+    NOT_OPTIMIZED_SUFFIX = '.original'
+
+    def __init__(self, cache_path: str = settings.IMAGE_OPTIMIZATION_CACHE_PATH,
+                 options: Optional[ImageOptimizationOptions] = None,
+                 max_workers: int = settings.IMAGE_OPTIMIZATION_WORKERS):
+        if Image is None:
+            raise ImportError('Pillow is required for the image optimization (pip install Pillow).')
+
+        self.cache_path = cache_path
+        self.options = options or ImageOptimizationOptions()
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        os.makedirs(cache_path, exist_ok=True)
+
+    def optimize(self, file_path: str, content_hash: Optional[str] = None) -> OptimizedImage:
+        content_hash = content_hash or get_file_content_hash(file_path)
+        optimized_file_path = os.path.join(self.cache_path, f'{content_hash}_{self.options.key}')
+
+        if os.path.exists(optimized_file_path):
+            return OptimizedImage(optimized_file_path)
+        if os.path.exists(optimized_file_path + self.NOT_OPTIMIZED_SUFFIX):
+            return OptimizedImage(file_path)
+
+        tmp_file_path = f'{optimized_file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            is_optimized = self._run(optimize_image, file_path, tmp_file_path, self.options)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            logger.error(f'Image {file_path} is not optimized: {e}')
+            is_optimized = False
+
+        if not is_optimized:
+            if os.path.exists(tmp_file_path):
+                os.remove(tmp_file_path)
+            open(optimized_file_path + self.NOT_OPTIMIZED_SUFFIX, 'wb').close()
+            return OptimizedImage(file_path)
+
+        os.replace(tmp_file_path, optimized_file_path)
+        return OptimizedImage(optimized_file_path)
+
+    def _run(self, function, *args):
+        if not self.max_workers:
+            return function(*args)
+
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+        return self._executor.submit(function, *args).result()
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+_shared_image_optimizer: Optional[ImageOptimizer] = None
+_shared_image_optimizer_pid: Optional[int] = None
+_shared_image_optimizer_lock = threading.Lock()
+
+
+def get_shared_image_optimizer() -> Optional[ImageOptimizer]:
+    """
+    The image optimizer configured by the IMAGE_* settings, None if settings.IMAGE_OPTIMIZATION is off.
+    A forked process creates its own, the process pool of the parent does not work in the child.
+    """
+    global _shared_image_optimizer, _shared_image_optimizer_pid
+
+    if not settings.IMAGE_OPTIMIZATION:
+        return None
+
+    with _shared_image_optimizer_lock:
+        if _shared_image_optimizer is None or _shared_image_optimizer_pid != os.getpid():
+            _shared_image_optimizer = ImageOptimizer()
+            _shared_image_optimizer_pid = os.getpid()
+
+    return _shared_image_optimizer
@@ -0,0 +1,205 @@
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Dict, Iterable, Iterator
+
+from sqlalchemy import event
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyHistogram:
+    """
+    Latency histogram with log-scale buckets (every bucket is GROWTH times wider than the previous one), so it
+    keeps a fixed amount of memory however many values are observed. The percentiles are estimated by the upper
+    bound of the bucket they fall into, i.e. with an error of at most GROWTH - 1 (~19%).
+    """
+    MIN_SECONDS = 1e-6
+    GROWTH = 2 ** 0.25
+
+    def __init__(self):
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def observe(self, seconds):
+        bucket = max(math.ceil(math.log(max(seconds, self.MIN_SECONDS) / self.MIN_SECONDS, self.GROWTH)), 0)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def get_percentile(self, percentile) -> float:
+        if not self.count:
+            return 0.0
+
+        rank = math.ceil(self.count * percentile / 100)
+        observed_count = 0
+        for bucket in sorted(self.buckets):
+            observed_count += self.buckets[bucket]
+            if observed_count >= rank:
+                return min(self.MIN_SECONDS * self.GROWTH ** bucket, self.max_seconds)
+
+        return self.max_seconds
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'total_seconds': round(self.total_seconds, 6),
+            'p50_seconds': round(self.get_percentile(50), 6),
+            'p99_seconds': round(self.get_percentile(99), 6),
+            'max_seconds': round(self.max_seconds, 6),
+        }
+
+
+class MigrationMetrics:
+    """
+    Thread-safe counters and per-stage latency histograms of the migration (parse, asset_lookup, upload, insert,
+    commit, sql, ...). The SQL queries are counted by the cursor execute events of the instrumented engines,
+    so the summary shows how many queries and how much DB time every news content costs.
+    """
+    NEWS_CONTENTS_COUNTER = 'news_contents'
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+        self._instrumented_engines = set()
+
+    def increment(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def measure(self, stage):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started_at)
+
+    def measure_iter(self, stage, iterable: Iterable) -> Iterator:
+        """
+        Times getting every item of the iterable, e.g. waiting for the next result of a process pool.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.measure(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def instrument_engine(self, engine):
+        if engine in self._instrumented_engines:
+            return
+
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        self._instrumented_engines.add(engine)
+
+    @staticmethod
+    def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        self.observe('sql', time.perf_counter() - connection.info['query_started_at'].pop())
+        self.increment('queries')
+
+    def summary(self) -> dict:
+        with self._lock:
+            elapsed_seconds = time.perf_counter() - self.started_at
+            counters = dict(self.counters)
+            stages = {stage: histogram.to_dict() for stage, histogram in sorted(self.histograms.items())}
+
+        news_contents_count = counters.get(self.NEWS_CONTENTS_COUNTER, 0)
+        queries_count = counters.get('queries', 0)
+        sql_seconds = stages.get('sql', {}).get('total_seconds', 0.0)
+
+        return {
+            'elapsed_seconds': round(elapsed_seconds, 3),
+            'news_contents_per_second': round(news_contents_count / elapsed_seconds, 3) if elapsed_seconds else 0.0,
+            'queries_per_news_content': round(queries_count / news_contents_count, 3) if news_contents_count else None,
+            'sql_seconds_per_news_content': (round(sql_seconds / news_contents_count, 6)
+                                             if news_contents_count else None),
+            'counters': counters,
+            'stages': stages,
+        }
+
+
+class MetricsReporter:
+    """
+    Logs the metrics summary every 'interval' seconds in a background thread (and once more on stop) and, if path
+    is set, appends it to that file as a JSON line.
+    """
+    def __init__(self, metrics: MigrationMetrics, interval: float = settings.METRICS_REPORT_INTERVAL,
+                 path: Optional[str] = settings.METRICS_PATH):
+        self.metrics = metrics
+        self.interval = interval
+        self.path = path
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        if self.interval > 0:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='metrics-reporter', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.report()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def report(self) -> dict:
+        summary = self.metrics.summary()
+        logger.info(f'Migration metrics: {json.dumps(summary)}')
+
+        if self.path:
+            with open(self.path, 'a', encoding='utf-8') as metrics_file:
+                metrics_file.write(json.dumps(summary) + '\n')
+
+        return summary
+
+
+_shared_migration_metrics: Optional[MigrationMetrics] = None
+_shared_migration_metrics_lock = threading.Lock()
+
+
+def get_shared_migration_metrics() -> MigrationMetrics:
+    global _shared_migration_metrics
+
+    with _shared_migration_metrics_lock:
+        if _shared_migration_metrics is None:
+            _shared_migration_metrics = MigrationMetrics()
+
+    return _shared_migration_metrics
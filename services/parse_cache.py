@@ -0,0 +1,81 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional, Any
+
+
+logger = logging.getLogger(__name__)
+
+
+class ParseResultCache:
+    """
+    Two-tier cache of the HTML parse results: an in-memory LRU in front of an optional SQLite file.
+    The key is the hash of the HTML together with the parser version and the extractor backend, so changing the
+    extraction rules (and the version) or switching the backend makes the old entries unreachable.
+    The values are stored as JSON.
+    """
+    def __init__(self, path: Optional[str] = None, memory_size: int = 1024):
+        self.path = path
+        self.memory_size = memory_size
+        self.hits = 0
+        self.misses = 0
+        self._memory_cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+
+        if path:
+            self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS parse_results (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self._connection.commit()
+
+    @staticmethod
+    def get_key(html: str, parser_version, extractor_backend: str) -> str:
+        key_hash = hashlib.sha256(f'{parser_version}\0{extractor_backend}\0'.encode())
+        key_hash.update(html.encode('utf-8', 'surrogatepass'))
+        return key_hash.hexdigest()
+
+    def get(self, key) -> Optional[Any]:
+        with self._lock:
+            value = self._memory_cache.get(key)
+            if value is not None:
+                self._memory_cache.move_to_end(key)
+            elif self._connection is not None:
+                row = self._connection.execute('SELECT value FROM parse_results WHERE key = ?', (key,)).fetchone()
+                value = json.loads(row[0]) if row else None
+                if value is not None:
+                    self._add_to_memory_cache(key, value)
+
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._add_to_memory_cache(key, value)
+
+            if self._connection is not None:
+                self._connection.execute('INSERT OR REPLACE INTO parse_results (key, value) VALUES (?, ?)',
+                                         (key, json.dumps(value)))
+                self._connection.commit()
+
+    def _add_to_memory_cache(self, key, value):
+        self._memory_cache[key] = value
+        self._memory_cache.move_to_end(key)
+
+        while len(self._memory_cache) > self.memory_size:
+            self._memory_cache.popitem(last=False)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
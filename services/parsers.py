@@ -1,29 +1,309 @@
 import logging
+import os
 import re
-from typing import List
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from typing import List, NamedTuple, Iterable, Tuple, Dict, Optional, Iterator
 from urllib.parse import unquote
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
+from bs4.builder import HTMLTreeBuilder
+from bs4.dammit import EntitySubstitution
+
+import settings
+from services.parse_cache import ParseResultCache
+from utils import stored_property
 
 
 logger = logging.getLogger(__name__)
 
 
+class HtmlParseResult(NamedTuple):
+    stripped_text: str
+    image_urls: List[str]
+    link_urls: List[str]
+    youtube_urls: List[str]
+    youtube_codes: List[str]
+
+
+class HtmlExtractor(ABC):
+    """
+    Collects the stripped text strings and the urls of the 'img' and 'a' tags (their 'src', or 'href' if there is
+    no 'src') in the document order.
+    """
+    @abstractmethod
+    def extract(self, text: str) -> Tuple[str, List[str], List[str]]:
+        pass
+
+    @staticmethod
+    def get_source_of_url_tag(attrs: dict) -> Optional[str]:
+        return attrs.get('src') if attrs.get('src') else attrs.get('href')
+
+
+class SoupHtmlExtractor(HtmlExtractor):
+    """
+    The reference extractor: builds the whole BeautifulSoup tree and walks it once.
+    """
+    parser = 'html.parser'
+
+    def extract(self, text: str) -> Tuple[str, List[str], List[str]]:
+        soup = BeautifulSoup(text, self.parser)
+        strings = []
+        image_urls = []
+        link_urls = []
+        string_types = soup.interesting_string_types
+
+        for element in soup.descendants:
+            if isinstance(element, Tag):
+                if element.name == 'img':
+                    image_urls.append(self.get_source_of_url_tag(element.attrs))
+                elif element.name == 'a':
+                    link_urls.append(self.get_source_of_url_tag(element.attrs))
+
+            elif type(element) in string_types:
+                stripped_string = element.strip()
+                if stripped_string:
+                    strings.append(stripped_string)
+
+        return ' '.join(strings), image_urls, link_urls
+
+
+class StreamingHtmlExtractor(HtmlExtractor):
+    """
+    Event-based extractor on top of the stdlib HTMLParser (the parser BeautifulSoup uses with 'html.parser'):
+    no tree is built, the text and the urls are collected while the document is read.
+    It follows the soup rules: the adjacent text pieces form one string, the comments, declarations and the
+    text inside script, style, template, rt and rp are skipped, the CDATA sections are kept, the character
+    references are converted the same way. The open tags are tracked like the soup tree: an end tag closes
+    the most recent open tag with its name and all the tags left open inside it, an end tag without an open
+    tag is ignored, so e.g. an unclosed rt ends with the element around it.
+    """
+    IGNORED_STRING_CONTAINERS = frozenset(('script', 'style', 'template', 'rt', 'rp'))
+    EMPTY_ELEMENT_TAGS = frozenset(HTMLTreeBuilder.empty_element_tags)
+
+    def extract(self, text: str) -> Tuple[str, List[str], List[str]]:
+        parser = _StreamingHtmlParser(self)
+        parser.feed(text)
+        parser.close()
+        return ' '.join(parser.strings), parser.image_urls, parser.link_urls
+
+
+class _StreamingHtmlParser(HTMLParser):
+
+    def __init__(self, extractor: StreamingHtmlExtractor):
+        super().__init__(convert_charrefs=False)
+        self.extractor = extractor
+        self.strings = []
+        self.image_urls = []
+        self.link_urls = []
+        self._string_pieces = []
+        self._open_tags = []
+        self._already_closed_empty_elements = []
+        self._ignored_containers_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        self._start_tag(tag, attrs)
+
+    def handle_startendtag(self, tag, attrs):
+        self._start_tag(tag, attrs, is_closed=False)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        # an explicit end tag of an empty element which is already closed is skipped without ending the string
+        if tag in self._already_closed_empty_elements:
+            self._already_closed_empty_elements.remove(tag)
+        else:
+            self._end_tag(tag)
+
+    def _start_tag(self, tag, attrs, is_closed=True):
+        self._flush_string()
+        self._open_tags.append(tag)
+        if tag in self.extractor.IGNORED_STRING_CONTAINERS:
+            self._ignored_containers_depth += 1
+
+        if tag in ('img', 'a'):
+            attrs = {name: '' if value is None else value for name, value in attrs}
+            urls = self.image_urls if tag == 'img' else self.link_urls
+            urls.append(self.extractor.get_source_of_url_tag(attrs))
+
+        if is_closed and tag in self.extractor.EMPTY_ELEMENT_TAGS:
+            self._end_tag(tag)
+            self._already_closed_empty_elements.append(tag)
+
+    def _end_tag(self, tag):
+        self._flush_string()
+        if tag not in self._open_tags:
+            return
+
+        while True:
+            open_tag = self._open_tags.pop()
+            if open_tag in self.extractor.IGNORED_STRING_CONTAINERS:
+                self._ignored_containers_depth -= 1
+            if open_tag == tag:
+                return
+
+    def handle_data(self, data):
+        if not self._ignored_containers_depth:
+            self._string_pieces.append(data)
+
+    def handle_charref(self, name):
+        """
+        The same conversion as BeautifulSoup does: the code points below 256 are read as windows-1252.
+        """
+        code_point = int(name[1:], 16) if name[:1] in ('x', 'X') else int(name)
+        data = None
+
+        if code_point < 256:
+            try:
+                data = bytes([code_point]).decode('windows-1252')
+            except UnicodeDecodeError:
+                pass
+
+        if not data:
+            try:
+                data = chr(code_point)
+            except (ValueError, OverflowError):
+                pass
+
+        self.handle_data(data or '\N{REPLACEMENT CHARACTER}')
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.handle_data(character if character is not None else f'&{name}')
+
+    def handle_comment(self, data):
+        self._flush_string()
+
+    def handle_decl(self, decl):
+        self._flush_string()
+
+    def handle_pi(self, data):
+        self._flush_string()
+
+    def unknown_decl(self, data):
+        self._flush_string()
+
+        # the soup keeps the CDATA sections even inside the ignored containers
+        if data.startswith('CDATA['):
+            self._string_pieces.append(data[len('CDATA['):])
+            self._flush_string()
+
+    def close(self):
+        super().close()
+        self._flush_string()
+
+    def _flush_string(self):
+        stripped_string = ''.join(self._string_pieces).strip()
+        self._string_pieces.clear()
+
+        if stripped_string:
+            self.strings.append(stripped_string)
+
+
+HTML_EXTRACTORS = {
+    'soup': SoupHtmlExtractor,
+    'streaming': StreamingHtmlExtractor,
+}
+
+
+class _ImageSourceParser(HTMLParser):
+
+    def __init__(self):
+        super().__init__()
+        self.image_urls = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'img':
+            attrs = {name: '' if value is None else value for name, value in attrs}
+            self.image_urls.append(HtmlExtractor.get_source_of_url_tag(attrs))
+
+    handle_startendtag = handle_starttag
+
+
+def parse_image_sources(html: str) -> List[str]:
+    """
+    Only the sources of the 'img' tags, taken the same way as the extractors take them: one streaming pass
+    without the text, the links and the youtube urls, e.g. to check the images before the migration.
+    """
+    parser = _ImageSourceParser()
+    parser.feed(html)
+    parser.close()
+    return parser.image_urls
+
+
+_shared_parse_cache: Optional[ParseResultCache] = None
+_shared_parse_cache_pid: Optional[int] = None
+_shared_parse_cache_lock = threading.Lock()
+
+
+def get_shared_parse_cache() -> Optional[ParseResultCache]:
+    """
+    The parse result cache stored in settings.PARSE_CACHE_PATH (None if it is not set). Every process (e.g. a parse
+    pool worker) opens its own connection to the cache file.
+    """
+    global _shared_parse_cache, _shared_parse_cache_pid
+
+    if not settings.PARSE_CACHE_PATH:
+        return None
+
+    with _shared_parse_cache_lock:
+        if _shared_parse_cache is None or _shared_parse_cache_pid != os.getpid():
+            _shared_parse_cache = ParseResultCache(settings.PARSE_CACHE_PATH, settings.PARSE_CACHE_MEMORY_SIZE)
+            _shared_parse_cache_pid = os.getpid()
+
+    return _shared_parse_cache
+
+
 class ParseTextFromHtmlService:
+    # Has to be increased on every change of the extraction rules: it is a part of the parse result cache key.
+    PARSER_VERSION = 2
+
     INDENTATION_SIZE = 4
     INDENTATION_SIGN = ' '
     YOUTUBE_URL = 'https://www.youtube.com/watch?v={code}'
 
-    parser = 'html.parser'
     youtube_urls_re = r'^((https?\:\/\/)?((www\.)?youtube\.com|youtu\.be)\/.+)$'
     youtube_tag_re = r'{youtube}([\d\w\-\_]+){\/youtube}'
 
-    def __init__(self, text: str):
+    def __init__(self, text: str, extractor_backend: str = settings.HTML_EXTRACTOR_BACKEND,
+                 parse_cache: Optional[ParseResultCache] = None):
         self.text = text
         self.parsed_text = ''
         self.parsed_image_urls = []
         self.parsed_youtube_urls = []
-        self.soup = BeautifulSoup(self.text, self.parser)
+        self.extractor_backend = extractor_backend
+        self.extractor = HTML_EXTRACTORS[extractor_backend]()
+        self.parse_cache = parse_cache if parse_cache is not None else get_shared_parse_cache()
+
+    @stored_property
+    def parse_result(self) -> HtmlParseResult:
+        """
+        Everything the migration extracts from the HTML, collected in one pass over the document
+        (or taken from the parse result cache, if the same HTML has already been parsed by this parser version
+        and extractor backend).
+        """
+        if self.parse_cache is None:
+            return self._parse()
+
+        cache_key = self.parse_cache.get_key(self.text, self.PARSER_VERSION, self.extractor_backend)
+        cached_parse_result = self.parse_cache.get(cache_key)
+        if cached_parse_result is not None:
+            return HtmlParseResult(*cached_parse_result)
+
+        parse_result = self._parse()
+        self.parse_cache.set(cache_key, parse_result)
+        return parse_result
+
+    def _parse(self) -> HtmlParseResult:
+        stripped_text, image_urls, link_urls = self.extractor.extract(self.text)
+
+        youtube_codes = re.findall(self.youtube_tag_re, self.text)
+        youtube_urls = self._get_youtube_urls(link_urls) + [self._create_youtube_url_from_code(code)
+                                                            for code in youtube_codes]
+
+        return HtmlParseResult(stripped_text, image_urls, link_urls, youtube_urls, youtube_codes)
 
     def parse_text(self) -> str:
         self._get_parsed_text()
@@ -31,9 +311,7 @@ class ParseTextFromHtmlService:
         return self.parsed_text
 
     def _get_parsed_text(self):
-        stripped_strings = self.soup.stripped_strings
-        text = ' '.join(stripped_strings)
-        self.parsed_text = self._delete_youtube_tags(text)
+        self.parsed_text = self._delete_youtube_tags(self.parse_result.stripped_text)
 
     def _delete_youtube_tags(self, text):
         return re.sub(self.youtube_tag_re, '', text)
@@ -45,34 +323,16 @@ class ParseTextFromHtmlService:
         self.parsed_text = self.INDENTATION_SIZE * self.INDENTATION_SIGN + self.parsed_text
 
     def parse_image_urls(self) -> List[str]:
-        self._get_image_urls()
-        return self.parsed_image_urls
-
-    def _get_source_of_url_tag(self, tag_name):
-        self.parsed_image_urls = [tag.attrs.get('src') if tag.attrs.get('src') else tag.attrs.get('href')
-                                  for tag in self.soup.findAll(tag_name)]
+        self.parsed_image_urls = list(self.parse_result.image_urls)
         return self.parsed_image_urls
 
-    def _get_image_urls(self):
-        return self._get_source_of_url_tag('img')
-
     def parse_youtube_urls(self) -> List[str]:
-        self.parsed_youtube_urls += self._get_youtube_urls()
-        self.parsed_youtube_urls += self._get_youtube_urls_from_tags()
+        self.parsed_youtube_urls += self.parse_result.youtube_urls
         return self.parsed_youtube_urls
 
-    def _get_youtube_urls(self) -> list:
-        try:
-            link_urls = self._get_source_of_url_tag('a')
-            youtube_pattern = re.compile(self.youtube_urls_re)
-            return [link for link in link_urls if youtube_pattern.search(link)]
-        except TypeError as e:
-            logger.error(f'Error getting youtube urls: {e}')
-            return []
-
-    def _get_youtube_urls_from_tags(self) -> list:
-        codes = re.findall(self.youtube_tag_re, self.text)
-        return [self._create_youtube_url_from_code(code) for code in codes]
+    def _get_youtube_urls(self, link_urls) -> list:
+        youtube_pattern = re.compile(self.youtube_urls_re)
+        return [link for link in link_urls if link and youtube_pattern.search(link)]
 
     def _create_youtube_url_from_code(self, code) -> str:
         return self.YOUTUBE_URL.format(code=code)
@@ -89,3 +349,70 @@ class ParseAbsoluteToDomesticUrlService:
         except TypeError as e:
             logger.info(f'Parse Absolute To Domestic Url have already received domestic Url.')
             return img_url
+
+
+class ParsedHtml(NamedTuple):
+    news_content_id: int
+    text: str
+    image_urls: List[str]
+    youtube_urls: List[str]
+
+
+def parse_news_content_html(news_content_id: int, html: str) -> ParsedHtml:
+    parse_service = ParseTextFromHtmlService(html)
+    return ParsedHtml(news_content_id, parse_service.parse_text(), parse_service.parse_image_urls(),
+                      parse_service.parse_youtube_urls())
+
+
+def _parse_news_content_html_item(item: Tuple[int, str]) -> ParsedHtml:
+    return parse_news_content_html(*item)
+
+
+class ParallelParseService:
+    """
+    Parses (news_content_id, html) pairs with ParseTextFromHtmlService in a process pool.
+    Only the compact ParsedHtml results are sent back to the parent process, which keeps all the ORM work.
+    With max_workers=0 the pairs are parsed serially in the current process. With chunksize=0 the chunk size is
+    derived from the number of the items, so even a small batch keeps all the workers busy.
+    """
+    def __init__(self, max_workers: int = settings.PARSE_WORKERS, chunksize: int = settings.PARSE_CHUNK_SIZE):
+        self.max_workers = max_workers
+        self.chunksize = chunksize
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def parse(self, items: Iterable[Tuple[int, str]]) -> Dict[int, ParsedHtml]:
+        return {parsed_html.news_content_id: parsed_html for parsed_html in self.iter_parse(items)}
+
+    def iter_parse(self, items: Iterable[Tuple[int, str]]) -> Iterator[ParsedHtml]:
+        """
+        Yields the results in the order of the items as soon as they are ready, so the caller can work on
+        the first results while the rest are still being parsed.
+        """
+        if not self.max_workers:
+            return map(_parse_news_content_html_item, items)
+
+        items = list(items)
+        return self.executor.map(_parse_news_content_html_item, items, chunksize=self.get_chunksize(len(items)))
+
+    def get_chunksize(self, items_count) -> int:
+        if self.chunksize:
+            return self.chunksize
+
+        return max(items_count // (self.max_workers * settings.PARSE_CHUNKS_PER_WORKER), 1)
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
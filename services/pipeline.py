@@ -0,0 +1,102 @@
+import queue
+import threading
+from contextlib import nullcontext
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import settings
+from services.metrics import MigrationMetrics
+
+
+class _PipelineEnd:
+    def __init__(self, error: Optional[BaseException] = None):
+        self.error = error
+
+
+class StagedPipeline:
+    """
+    Runs the items of the source through the stages, every stage (and the source) in its own thread, connected
+    by queues of at most 'queue_size' items. The results of the last stage are yielded in the calling thread,
+    so the caller is the last stage itself. All the stages work at the same time on different items and
+    a slow stage throttles the ones before it: they block on a full queue instead of piling the items up.
+
+    An error in any stage stops the pipeline and is raised in the calling thread; if the caller stops iterating,
+    the stage threads are stopped as well.
+    """
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, stages: List[Tuple[str, Callable]], queue_size: int = settings.PIPELINE_QUEUE_SIZE,
+                 metrics: Optional[MigrationMetrics] = None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.metrics = metrics
+        self._stopped = threading.Event()
+
+    def run(self, source: Iterable, source_name: str = 'source') -> Iterator:
+        self._stopped.clear()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._run_source, args=(source_name, source, queues[0]),
+                                    name=f'pipeline-{source_name}', daemon=True)]
+        threads += [threading.Thread(target=self._run_stage, args=(stage_name, function, queues[index],
+                                                                   queues[index + 1]),
+                                     name=f'pipeline-{stage_name}', daemon=True)
+                    for index, (stage_name, function) in enumerate(self.stages)]
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if isinstance(item, _PipelineEnd):
+                    if item.error is not None:
+                        raise item.error
+                    return
+                yield item
+        finally:
+            self._stopped.set()
+            for thread in threads:
+                thread.join()
+
+    def _run_source(self, source_name, source, output_queue):
+        try:
+            iterator = iter(source)
+            while not self._stopped.is_set():
+                with self._measure(source_name):
+                    item = next(iterator, _PipelineEnd())
+                self._put(output_queue, item)
+                if isinstance(item, _PipelineEnd):
+                    return
+        except BaseException as e:
+            self._put(output_queue, _PipelineEnd(e))
+
+    def _run_stage(self, stage_name, function, input_queue, output_queue):
+        try:
+            while not self._stopped.is_set():
+                item = self._get(input_queue)
+                if not isinstance(item, _PipelineEnd):
+                    with self._measure(stage_name):
+                        item = function(item)
+                self._put(output_queue, item)
+                if isinstance(item, _PipelineEnd):
+                    return
+        except BaseException as e:
+            self._put(output_queue, _PipelineEnd(e))
+
+    def _get(self, input_queue):
+        while True:
+            try:
+                return input_queue.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                if self._stopped.is_set():
+                    return _PipelineEnd()
+
+    def _put(self, output_queue, item):
+        while not self._stopped.is_set():
+            try:
+                return output_queue.put(item, timeout=self.POLL_INTERVAL)
+            except queue.Full:
+                pass
+
+    def _measure(self, stage_name):
+        return self.metrics.measure(f'pipeline:{stage_name}') if self.metrics else nullcontext()
+
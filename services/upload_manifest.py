@@ -0,0 +1,74 @@
+import hashlib
+import logging
+import mmap
+import sqlite3
+import threading
+from typing import Optional, Dict
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_file_content_hash(file_path) -> str:
+    """
+    MD5 of the file content. The file is memory-mapped, so big images are hashed without being copied into memory.
+    MD5 is used because it is what S3 returns as the ETag of the objects uploaded with a single PUT.
+    """
+    content_hash = hashlib.md5(usedforsecurity=False)
+
+    with open(file_path, 'rb') as fileobj:
+        try:
+            with mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ) as file_content:
+                content_hash.update(file_content)
+        except ValueError:
+            # an empty file cannot be memory-mapped
+            pass
+
+    return content_hash.hexdigest()
+
+
+class UploadManifest:
+    """
+    Persistent 'content hash -> S3 key' map of the uploaded files stored in a local SQLite DB.
+    It is safe to share between the upload threads.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS uploaded_files (content_hash TEXT PRIMARY KEY, key TEXT NOT NULL)')
+        self._connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM uploaded_files').fetchone()[0]
+
+    def get_key(self, content_hash) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT key FROM uploaded_files WHERE content_hash = ?', (content_hash,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, content_hash, key):
+        self.add_many({content_hash: key})
+
+    def add_many(self, keys_by_content_hash: Dict[str, str]):
+        with self._lock:
+            self._connection.executemany('INSERT OR IGNORE INTO uploaded_files (content_hash, key) VALUES (?, ?)',
+                                         keys_by_content_hash.items())
+            self._connection.commit()
+
+    def seed_from_storage(self, storage_backend, key_prefix=''):
+        """
+        Adds the objects already stored in the storage. The ETag of an object uploaded to S3 with a single PUT is
+        the MD5 of its content; the multipart ETags ('<md5>-<parts count>') are not content hashes and are skipped.
+        """
+        object_etags = storage_backend.get_objects_etags(key_prefix)
+        keys_by_content_hash = {etag: key for key, etag in object_etags.items() if '-' not in etag}
+        self.add_many(keys_by_content_hash)
+        logger.info(f'Upload manifest is seeded with {len(keys_by_content_hash)} stored objects.')
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
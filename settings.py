@@ -16,4 +16,73 @@ ASSET_MANAGER_S3 = {
 TEST_DB_CONNECTION_STRING = 'sqlite://'
 PROD_DB_CONNECTION_STRING = os.getenv('DB_CONNECTION_STRING')
 
-SQL_SERVER_PARAMETER_LIMIT = 3600
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+DB_LOG_LEVEL = os.getenv('DB_LOG_LEVEL', 'WARNING').upper()
+DB_FAST_EXECUTEMANY = os.getenv('DB_FAST_EXECUTEMANY', 'true').lower() in ('1', 'true', 'yes')
+DB_INSERTMANYVALUES_PAGE_SIZE = int(os.getenv('DB_INSERTMANYVALUES_PAGE_SIZE', 1000))
+
+# SQL Server accepts at most 2100 parameters per request, pyodbc needs two of them for sp_prepexec
+SQL_SERVER_PARAMETER_LIMIT = 2098
+# the most rows a table value constructor (INSERT ... VALUES (...), (...)) may have in SQL Server
+SQL_SERVER_MAX_VALUES_ROWS = 1000
+
+BULK_MUTATION_CHUNK_SIZE = int(os.getenv('BULK_MUTATION_CHUNK_SIZE', 4000))
+
+ASSETS_INDEX_SNAPSHOT_PATH = os.getenv('ASSETS_INDEX_SNAPSHOT_PATH')
+
+PREPARE_BATCH_SIZE = int(os.getenv('PREPARE_BATCH_SIZE', 500))
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 500))
+
+MODIFY_BATCH_SIZE = int(os.getenv('MODIFY_BATCH_SIZE', 25))
+
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', 0))
+# 0: the items of a batch are split into PARSE_CHUNKS_PER_WORKER chunks per worker
+PARSE_CHUNK_SIZE = int(os.getenv('PARSE_CHUNK_SIZE', 0))
+PARSE_CHUNKS_PER_WORKER = 4
+
+MIGRATION_SHARDS = int(os.getenv('MIGRATION_SHARDS', 1))
+MIGRATION_SHARD_INDEXES = [int(shard_index) for shard_index in os.getenv('MIGRATION_SHARD_INDEXES', '').split(',')
+                           if shard_index]
+
+MIGRATION_RESUME = os.getenv('MIGRATION_RESUME', '').lower() in ('1', 'true', 'yes')
+# off on all but one of the machines sharing the DB: the sharded run skips the prepare stage
+MIGRATION_PREPARE = os.getenv('MIGRATION_PREPARE', 'true').lower() in ('1', 'true', 'yes')
+
+MIGRATION_PIPELINE = os.getenv('MIGRATION_PIPELINE', '').lower() in ('1', 'true', 'yes')
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 2))
+
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 8))
+
+IMAGES_ROOT_PATH = os.getenv('IMAGES_ROOT_PATH')
+IMAGE_INDEX_WORKERS = int(os.getenv('IMAGE_INDEX_WORKERS', 8))
+UNRESOLVED_IMAGES_REPORT_PATH = os.getenv('UNRESOLVED_IMAGES_REPORT_PATH')
+
+IMAGE_OPTIMIZATION = os.getenv('IMAGE_OPTIMIZATION', '').lower() in ('1', 'true', 'yes')
+IMAGE_OPTIMIZATION_CACHE_PATH = os.getenv('IMAGE_OPTIMIZATION_CACHE_PATH', 'image_cache')
+IMAGE_OPTIMIZATION_WORKERS = int(os.getenv('IMAGE_OPTIMIZATION_WORKERS', os.cpu_count() or 1))
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', 1000))
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 82))
+IMAGE_WEBP = os.getenv('IMAGE_WEBP', '').lower() in ('1', 'true', 'yes')
+IMAGE_STRIP_METADATA = os.getenv('IMAGE_STRIP_METADATA', 'true').lower() in ('1', 'true', 'yes')
+
+UPLOAD_MANIFEST_PATH = os.getenv('UPLOAD_MANIFEST_PATH')
+UPLOAD_MANIFEST_SEED_PREFIX = os.getenv('UPLOAD_MANIFEST_SEED_PREFIX')
+
+MULTIPART_UPLOAD_THRESHOLD = int(os.getenv('MULTIPART_UPLOAD_THRESHOLD', 16 * 1024 * 1024))
+MULTIPART_UPLOAD_PART_SIZE = int(os.getenv('MULTIPART_UPLOAD_PART_SIZE', 8 * 1024 * 1024))
+MULTIPART_UPLOAD_CONCURRENCY = int(os.getenv('MULTIPART_UPLOAD_CONCURRENCY', 4))
+
+FILE_STORAGE_BACKEND = os.getenv('FILE_STORAGE_BACKEND', 's3')
+LOCAL_STORAGE_PATH = os.getenv('LOCAL_STORAGE_PATH', 'storage')
+LOCAL_STORAGE_LATENCY = float(os.getenv('LOCAL_STORAGE_LATENCY', 0))
+LOCAL_STORAGE_BANDWIDTH = int(os.getenv('LOCAL_STORAGE_BANDWIDTH', 0)) or None
+
+HTML_EXTRACTOR_BACKEND = os.getenv('HTML_EXTRACTOR_BACKEND', 'soup')
+
+PARSE_CACHE_PATH = os.getenv('PARSE_CACHE_PATH')
+PARSE_CACHE_MEMORY_SIZE = int(os.getenv('PARSE_CACHE_MEMORY_SIZE', 1024))
+
+METRICS_REPORT_INTERVAL = float(os.getenv('METRICS_REPORT_INTERVAL', 60))
+METRICS_PATH = os.getenv('METRICS_PATH')
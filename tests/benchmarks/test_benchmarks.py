@@ -0,0 +1,38 @@
+import tempfile
+import unittest
+
+from benchmarks.corpus import SyntheticCorpusGenerator
+from benchmarks.run_benchmark import MigrationBenchmark
+from services.parsers import ParseTextFromHtmlService
+
+
+class TestSyntheticCorpusGenerator(unittest.TestCase):
+    generator = SyntheticCorpusGenerator
+
+    def test_generate_news_contents(self):
+        news_contents = list(self.generator(10, images_count=5, seed=1).generate_news_contents())
+        image_paths = set(self.generator(10, images_count=5).image_paths)
+
+        self.assertEqual(list(range(1, 11)), [news_content['news_content_id'] for news_content in news_contents])
+        self.assertEqual(news_contents, list(self.generator(10, images_count=5, seed=1).generate_news_contents()))
+
+        for news_content in news_contents:
+            parse_service = ParseTextFromHtmlService(news_content['text'])
+            self.assertTrue(set(parse_service.parse_image_urls()) <= image_paths)
+            self.assertTrue(news_content['view_data']['image_intro'].startswith('http://chasha.by/images/'))
+
+
+class TestMigrationBenchmark(unittest.TestCase):
+    benchmark = MigrationBenchmark
+
+    def test_run(self):
+        corpus = SyntheticCorpusGenerator(6, images_count=8, image_size=8)
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = self.benchmark(corpus, work_dir, batch_size=4).run()
+
+        self.assertEqual(6, results['rows_count'])
+        self.assertCountEqual(self.benchmark.STAGES, results['stages'])
+        self.assertEqual(6, results['stages']['parse']['calls'])
+        self.assertTrue(results['stages']['upload']['calls'])
+        self.assertTrue(results['rows_per_second'])
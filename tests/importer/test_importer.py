@@ -0,0 +1,90 @@
+import codecs
+import csv
+import io
+import json
+import os
+import tempfile
+from unittest import mock
+
+from sqlalchemy import select
+
+from db import models
+from db.sessions import DBSessionManager
+from importer import NewsContentCsvImporter
+from processor import MigrationProgressService
+from tests.base import test_engine, AppTestCase
+from tests.services import mocks
+
+
+class TestNewsContentCsvImporter(AppTestCase):
+    importer = NewsContentCsvImporter
+    NEWS_CONTENT_IDS = [322, 323, 324, 325, 326]
+
+    def setUp(self):
+        super().setUp()
+        csv_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(csv_dir.cleanup)
+        self.csv_path = os.path.join(csv_dir.name, 'body_content.csv')
+
+        csv_content = io.StringIO()
+        csv_writer = csv.DictWriter(csv_content, fieldnames=list(mocks.TEST_PARSE_TEXT_FROM_HTML_SERVICE))
+        csv_writer.writeheader()
+        for news_content_id in self.NEWS_CONTENT_IDS:
+            csv_writer.writerow({**mocks.TEST_PARSE_TEXT_FROM_HTML_SERVICE, 'NewsContentId': news_content_id,
+                                 'ImagesData': json.dumps(mocks.TEST_PARSE_TEXT_FROM_HTML_SERVICE['ImagesData'])})
+
+        with open(self.csv_path, 'wb') as csv_file:
+            csv_file.write(codecs.BOM_UTF8 + csv_content.getvalue().encode('utf-8'))
+
+    def test_import_csv(self):
+        rows_count = self.importer(test_engine, self.csv_path, batch_size=2).import_csv()
+
+        with DBSessionManager(test_engine) as current_session:
+            news_contents = current_session.scalars(
+                select(models.NewsContent).order_by(models.NewsContent.news_content_id)).all()
+            progress = MigrationProgressService(current_session).get_progress(self.importer(
+                test_engine, self.csv_path).stage)
+
+            self.assertEqual(len(self.NEWS_CONTENT_IDS), rows_count)
+            self.assertEqual(self.NEWS_CONTENT_IDS, [news_content.news_content_id for news_content in news_contents])
+            self.assertEqual(mocks.TEST_PARSE_TEXT_FROM_HTML_SERVICE['Text'], news_contents[0].text)
+            self.assertEqual(mocks.TEST_PARSE_TEXT_FROM_HTML_SERVICE['ImagesData'], news_contents[0].view_data)
+            self.assertEqual('2023-03-26 18:42:18', str(news_contents[0].created_date))
+            self.assertEqual((3, True, os.path.getsize(self.csv_path)),
+                             (progress.batches_count, progress.is_finished, progress.last_byte_offset))
+
+    def test_import_csv_resumes_after_last_batch(self):
+        importer = self.importer(test_engine, self.csv_path, batch_size=2)
+        batches = importer.iter_batches
+
+        def fail_after_first_batch(byte_offset=None):
+            news_contents_values, byte_offset = next(batches(byte_offset))
+            yield news_contents_values, byte_offset
+            raise ConnectionError
+
+        with mock.patch.object(importer, 'iter_batches', fail_after_first_batch):
+            with self.assertRaises(ConnectionError):
+                importer.import_csv()
+
+        rows_count = importer.import_csv(resume=True)
+
+        with DBSessionManager(test_engine) as current_session:
+            news_content_ids = current_session.scalars(
+                select(models.NewsContent.news_content_id).order_by(models.NewsContent.news_content_id)).all()
+
+        self.assertEqual(3, rows_count)
+        self.assertEqual(self.NEWS_CONTENT_IDS, news_content_ids)
+
+    def test_import_csv_with_long_text(self):
+        text = 'a' * (csv.field_size_limit() + 1)
+        with open(self.csv_path, 'w', encoding='utf-8', newline='') as csv_file:
+            csv_writer = csv.DictWriter(csv_file, fieldnames=['NewsContentId', 'Text'])
+            csv_writer.writeheader()
+            csv_writer.writerow({'NewsContentId': 322, 'Text': text})
+        field_size_limit = csv.field_size_limit()
+
+        self.assertEqual(1, self.importer(test_engine, self.csv_path).import_csv())
+        self.assertEqual(field_size_limit, csv.field_size_limit())
+
+        with DBSessionManager(test_engine) as current_session:
+            self.assertEqual(text, current_session.scalar(select(models.NewsContent.text)))
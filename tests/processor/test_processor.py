@@ -1,9 +1,19 @@
-from sqlalchemy import insert, select
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from sqlalchemy import insert, select, update, delete, create_engine, event
 from sqlalchemy.sql.functions import func
 
+from benchmarks.corpus import SyntheticCorpusGenerator
 from db import models
+from db.models import mapper_registry
 from db.sessions import DBSessionManager
-from processor import DbDataModifier
+from processor import DbDataModifier, AssetsService, AssetsIndex, NewsContentAssetsWriter, NewsContentService, \
+    MigrationProgressService, DbPreparingService, NewsContentText
+from services.file_uploader import FileUploader, FileUploadProcessor, LocalStorageBackend
+from services.image_index import LocalImageIndex
 from tests.base import test_engine, AppTestCase
 from tests.services import mocks
 
@@ -19,7 +29,7 @@ class TestParseTextFromHtmlService(AppTestCase):
 
     def test_processor(self):
         with DBSessionManager(test_engine) as current_session:
-            self.processor().process_db(test_engine)
+            self.processor(test_engine).process_db()
 
             assets_count_stmt = select(func.count(models.Assets.asset_id))
             assets_count = current_session.scalar(assets_count_stmt)
@@ -35,3 +45,395 @@ class TestParseTextFromHtmlService(AppTestCase):
             self.assertEqual(2, assets_count)
             self.assertTrue(news_content.main_asset_id)
             self.assertTrue(news_content.view_data.get('youtube'))
+
+
+class TestReportUnresolvedImages(AppTestCase):
+    processor = DbDataModifier
+
+    def setUp(self):
+        super().setUp()
+        with DBSessionManager(test_engine) as current_session:
+            current_session.execute(insert(models.NewsContent).values(**mocks.TEST_NEWS_CONTENT_ENTITY))
+            current_session.execute(insert(models.NewsContent).values(
+                news_content_id=323, title='News 323', text='<p><img alt="no src"><img src="images/missing.jpg"></p>'))
+
+        root_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(root_dir.cleanup)
+        self.root_path = root_dir.name
+        os.makedirs(os.path.join(self.root_path, 'tests', 'processor', 'test_pictures'))
+        with open(os.path.join(self.root_path, 'tests', 'processor', 'test_pictures', 'test_picture_1.jpg'), 'wb'):
+            pass
+
+    def test_report_unresolved_images(self):
+        file_uploader = FileUploader(image_index=LocalImageIndex(self.root_path).scan())
+        report_path = os.path.join(self.root_path, 'unresolved_images.json')
+        processor = self.processor(test_engine, file_uploader=file_uploader, upload_workers=0)
+
+        processor.prepare_db_data(resume=False)
+        processor._modify_db_data()
+        unresolved_images = processor.report_unresolved_images(report_path=report_path)
+
+        with open(report_path, encoding='utf-8') as report_file:
+            self.assertEqual(unresolved_images, json.load(report_file))
+        self.assertEqual({'tests/processor/test_pictures/test_picture_2.png': [322], 'images/missing.jpg': [323]},
+                         unresolved_images)
+        uploaded_keys = [call.args[1] for call in self.upload_file_from_path_mock.call_args_list]
+        self.assertEqual(['test_picture_1.jpg'], uploaded_keys)
+
+    def test_check_unresolved_images_before_uploads(self):
+        file_uploader = FileUploader(image_index=LocalImageIndex(self.root_path).scan())
+        processor = self.processor(test_engine, file_uploader=file_uploader, upload_workers=0)
+        processor._load_assets_index()
+
+        unresolved_images = processor.check_unresolved_images()
+
+        self.assertEqual({'tests/processor/test_pictures/test_picture_2.png': [322], 'images/missing.jpg': [323]},
+                         unresolved_images)
+        self.upload_file_from_path_mock.assert_not_called()
+
+    def test_unresolved_images_are_reported_when_run_fails(self):
+        processor = self.processor(test_engine, upload_workers=0)
+
+        with mock.patch.object(processor, '_modify_db_data', side_effect=RuntimeError), \
+                mock.patch.object(processor, 'report_unresolved_images') as report_unresolved_images:
+            with self.assertRaises(RuntimeError):
+                processor.process_db(resume=False)
+
+        report_unresolved_images.assert_called_once_with()
+
+
+class TestNewsContentKeysetPagination(AppTestCase):
+    processor = DbDataModifier
+    NEWS_CONTENT_IDS = [101, 102, 103, 104, 105]
+
+    def setUp(self):
+        super().setUp()
+        with DBSessionManager(test_engine) as current_session:
+            news_content_stmt = insert(models.NewsContent)
+            current_session.execute(news_content_stmt, [
+                {'news_content_id': news_content_id, 'title': f'News {news_content_id}', 'text': '<p>text</p>'}
+                for news_content_id in self.NEWS_CONTENT_IDS
+            ])
+
+    def test_iter_news_content_batches(self):
+        batches = [[news_content.news_content_id for news_content in news_contents]
+                   for news_contents, _ in self.processor(test_engine, batch_size=2)._iter_news_content_batches()]
+
+        self.assertEqual([[105, 104], [103, 102], [101]], batches)
+
+    def test_iter_news_content_batches_for_interval(self):
+        batches = [[news_content.news_content_id for news_content in news_contents]
+                   for news_contents, _ in self.processor(test_engine, batch_size=2)._iter_news_content_batches(
+                       start_news_content_id=102, end_news_content_id=104)]
+
+        self.assertEqual([[104, 103], [102]], batches)
+
+    def test_modify_db_data_resumes_after_last_checkpoint(self):
+        with DBSessionManager(test_engine) as current_session:
+            MigrationProgressService(current_session).save_batch(self.processor.MODIFY_STAGE, 104, 2)
+
+        processor = self.processor(test_engine, batch_size=2)
+        news_contents_count = processor._modify_db_data()
+
+        with DBSessionManager(test_engine) as current_session:
+            progress = MigrationProgressService(current_session).get_progress(self.processor.MODIFY_STAGE)
+            news_content_texts = current_session.scalars(
+                select(models.NewsContent.text).order_by(models.NewsContent.news_content_id)).all()
+
+            self.assertEqual(3, news_contents_count)
+            self.assertEqual((101, 3, 5, True), (progress.last_news_content_id, progress.batches_count,
+                                                  progress.rows_count, progress.is_finished))
+            self.assertEqual(['    text'] * 3 + ['<p>text</p>'] * 2, news_content_texts)
+            self.assertEqual(0, processor._modify_db_data())
+
+    def test_prepare_db_data_in_chunks(self):
+        with DBSessionManager(test_engine) as current_session:
+            current_session.execute(update(models.NewsContent).where(
+                models.NewsContent.news_content_id.in_([102, 104])).values(
+                text='<a href="https://www.youtube.com/watch?v=code">'))
+
+        processor = self.processor(test_engine, batch_size=2)
+        processor._prepare_progress(test_engine, False, *DbPreparingService.STAGES)
+        DbPreparingService(test_engine, AssetsIndex(snapshot_path=None), batch_size=2).prepare_db_data()
+
+        view_data_stmt = select(models.NewsContent.news_content_id, models.NewsContent.view_data).where(
+            models.NewsContent.view_data.is_not(None))
+        with DBSessionManager(test_engine) as current_session:
+            main_image_progress = MigrationProgressService(current_session).get_progress(
+                DbPreparingService.MAIN_IMAGE_STAGE)
+            main_image_progress_values = (main_image_progress.batches_count, main_image_progress.rows_count,
+                                          main_image_progress.is_finished)
+            prepared_view_data = dict(current_session.execute(view_data_stmt).all())
+
+        processor._modify_db_data()
+        with DBSessionManager(test_engine) as current_session:
+            modified_view_data = dict(current_session.execute(view_data_stmt).all())
+
+        self.assertEqual((3, 5, True), main_image_progress_values)
+        # the youtube urls are written by the modify pass from the same parse result as the text
+        self.assertEqual({}, prepared_view_data)
+        self.assertEqual({102: {'youtube': ['https://www.youtube.com/watch?v=code']},
+                          104: {'youtube': ['https://www.youtube.com/watch?v=code']}}, modified_view_data)
+
+    def test_get_news_content_id_ranges(self):
+        with DBSessionManager(test_engine) as current_session:
+            news_content_id_ranges = NewsContentService(current_session).get_news_content_id_ranges(2)
+
+        self.assertEqual([(101, 103), (104, 105)], news_content_id_ranges)
+
+    def test_update_news_content_texts(self):
+        with DBSessionManager(test_engine) as current_session:
+            news_service = NewsContentService(current_session)
+            news_contents = news_service.get_news_content_texts_page(limit=2)
+            news_service.update_news_content_texts(
+                NewsContentText(news_content.news_content_id, f'text {news_content.news_content_id}')
+                for news_content in news_contents)
+
+        with DBSessionManager(test_engine) as current_session:
+            news_content_stmt = select(models.NewsContent.news_content_id, models.NewsContent.text)
+            news_content_texts = dict(current_session.execute(news_content_stmt).all())
+
+        self.assertEqual([NewsContentText(105, '<p>text</p>'), NewsContentText(104, '<p>text</p>')], news_contents)
+        self.assertEqual({101: '<p>text</p>', 102: '<p>text</p>', 103: '<p>text</p>', 104: 'text 104',
+                          105: 'text 105'}, news_content_texts)
+
+
+class TestAssetsService(AppTestCase):
+    service = AssetsService
+    NEWS_CONTENT_ID = 322
+    FILE_NAMES = ['test_picture_1.jpg', 'test_picture_2.png', 'test_picture_3.png']
+
+    def setUp(self):
+        super().setUp()
+        with DBSessionManager(test_engine) as current_session:
+            current_session.execute(insert(models.NewsContent).values(**mocks.TEST_NEWS_CONTENT_ENTITY))
+
+    def test_create_assets_with_references(self):
+        with DBSessionManager(test_engine) as current_session:
+            asset_ids = self.service(current_session).create_assets_with_references(self.NEWS_CONTENT_ID,
+                                                                                    self.FILE_NAMES)
+
+            assets_stmt = select(models.Assets.asset_id, models.Assets.file_name).order_by(models.Assets.asset_id)
+            assets = current_session.execute(assets_stmt).all()
+
+            news_assets_stmt = select(models.NewsContentAssets.c.asset_id).where(
+                models.NewsContentAssets.c.news_content_id == self.NEWS_CONTENT_ID)
+            news_asset_ids = current_session.scalars(news_assets_stmt).all()
+
+            self.assertEqual(list(zip(asset_ids, self.FILE_NAMES)), [tuple(asset) for asset in assets])
+            self.assertCountEqual(asset_ids, news_asset_ids)
+
+    def test_create_assets_in_one_statement(self):
+        statements = []
+
+        def before_cursor_execute(connection, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(test_engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, test_engine, 'before_cursor_execute', before_cursor_execute)
+
+        with DBSessionManager(test_engine) as current_session:
+            asset_ids = self.service(current_session).create_assets(self.FILE_NAMES)
+
+        self.assertEqual(1, len([statement for statement in statements if statement.startswith('INSERT INTO assets')]))
+        self.assertEqual(len(self.FILE_NAMES), len(set(asset_ids)))
+
+    def test_create_assets_reuses_concurrently_created_assets(self):
+        with DBSessionManager(test_engine) as current_session:
+            existing_asset_id = self.service(current_session).create_asset(self.FILE_NAMES[1]).asset_id
+
+        with DBSessionManager(test_engine) as current_session:
+            asset_ids = self.service(current_session).create_assets(self.FILE_NAMES)
+            assets_count = current_session.scalar(select(func.count(models.Assets.asset_id)))
+
+        self.assertEqual(existing_asset_id, asset_ids[1])
+        self.assertEqual(len(self.FILE_NAMES), len(set(asset_ids)))
+        self.assertEqual(len(self.FILE_NAMES), assets_count)
+
+
+class TestAssetsIndex(AppTestCase):
+    index = AssetsIndex
+    FILE_NAMES = ['test_picture_1.jpg', 'test_picture_2.png']
+
+    def setUp(self):
+        super().setUp()
+        with DBSessionManager(test_engine) as current_session:
+            self.asset_ids = AssetsService(current_session).create_assets(self.FILE_NAMES)
+
+        snapshot_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshot_dir.cleanup)
+        self.snapshot_path = os.path.join(snapshot_dir.name, 'assets_index.json')
+
+    def test_load(self):
+        with DBSessionManager(test_engine) as current_session:
+            assets_index = self.index(snapshot_path=None).load(current_session)
+
+        self.assertTrue(assets_index.is_loaded)
+        self.assertEqual(self.asset_ids, [assets_index.get_asset_id(file_name) for file_name in self.FILE_NAMES])
+        self.assertIsNone(assets_index.get_asset_id('missing.jpg'))
+
+    def test_load_from_snapshot(self):
+        with DBSessionManager(test_engine) as current_session:
+            self.index(snapshot_path=self.snapshot_path).load(current_session).save_snapshot()
+            new_asset_id = AssetsService(current_session).create_asset('test_picture_3.png').asset_id
+
+        with DBSessionManager(test_engine) as current_session:
+            assets_index = self.index(snapshot_path=self.snapshot_path).load(current_session)
+
+        self.assertEqual(3, len(assets_index))
+        self.assertEqual(new_asset_id, assets_index.get_asset_id('test_picture_3.png'))
+
+    def test_snapshot_not_matching_db_is_discarded(self):
+        with DBSessionManager(test_engine) as current_session:
+            self.index(snapshot_path=self.snapshot_path).load(current_session).save_snapshot()
+
+        for file_names in (['test_picture_3.png'], list(reversed(self.FILE_NAMES))):
+            with self.subTest(file_names=file_names), DBSessionManager(test_engine) as current_session:
+                current_session.execute(delete(models.Assets))
+                asset_ids = AssetsService(current_session).create_assets(file_names)
+                current_session.commit()
+
+                assets_index = self.index(snapshot_path=self.snapshot_path).load(current_session)
+
+                self.assertEqual(dict(zip(file_names, asset_ids)), assets_index.asset_ids_by_file_name)
+
+    def test_old_snapshot_format_is_discarded(self):
+        with open(self.snapshot_path, 'w', encoding='utf-8') as snapshot_file:
+            json.dump({'stale.jpg': 1}, snapshot_file)
+
+        with DBSessionManager(test_engine) as current_session:
+            assets_index = self.index(snapshot_path=self.snapshot_path).load(current_session)
+
+        self.assertEqual(dict(zip(self.FILE_NAMES, self.asset_ids)), assets_index.asset_ids_by_file_name)
+
+
+class TestNewsContentAssetsWriter(AppTestCase):
+    writer = NewsContentAssetsWriter
+    NEWS_CONTENT_ID = 322
+
+    def setUp(self):
+        super().setUp()
+        with DBSessionManager(test_engine) as current_session:
+            current_session.execute(insert(models.NewsContent).values(**mocks.TEST_NEWS_CONTENT_ENTITY))
+            self.asset_ids = AssetsService(current_session).create_assets(['test_picture_1.jpg', 'test_picture_2.png'])
+            AssetsService(current_session).create_reference_between_news_and_assets(self.NEWS_CONTENT_ID,
+                                                                                    self.asset_ids[0])
+
+    def test_flush(self):
+        with DBSessionManager(test_engine) as current_session:
+            links_writer = self.writer(current_session).load_existing_links([self.NEWS_CONTENT_ID])
+            self.assertTrue(links_writer.has_links(self.NEWS_CONTENT_ID))
+
+            for asset_id in self.asset_ids * 2:
+                links_writer.add(self.NEWS_CONTENT_ID, asset_id)
+            links_writer.flush()
+
+            news_assets_stmt = select(models.NewsContentAssets.c.asset_id).where(
+                models.NewsContentAssets.c.news_content_id == self.NEWS_CONTENT_ID)
+            news_asset_ids = current_session.scalars(news_assets_stmt).all()
+
+        self.assertCountEqual(self.asset_ids, news_asset_ids)
+
+
+class TestDbDataModifierPipeline(TestCase):
+    processor = DbDataModifier
+
+    def setUp(self):
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+        self.work_dir = work_dir.name
+        self.corpus = SyntheticCorpusGenerator(12, images_count=10, image_size=8, seed=1)
+        self.corpus.write_images(self.work_dir)
+
+    def test_pipeline_gives_the_same_result(self):
+        self.assertEqual(self.run_migration(pipeline=False), self.run_migration(pipeline=True))
+
+    def test_pipeline_does_not_upload_images_of_linked_articles(self):
+        engine = self.create_engine('linked')
+        with DBSessionManager(engine) as current_session:
+            asset_id, = AssetsService(current_session).create_assets(['linked.jpg'])
+            news_content_ids = current_session.scalars(select(models.NewsContent.news_content_id)).all()
+            current_session.execute(insert(models.NewsContentAssets), [
+                {'news_content_id': news_content_id, 'asset_id': asset_id} for news_content_id in news_content_ids])
+
+        storage_backend = LocalStorageBackend(os.path.join(self.work_dir, 'storage_linked'))
+        self.create_processor(engine, storage_backend, pipeline=True).modify_db_data_for_entities(
+            engine, min(news_content_ids), max(news_content_ids), resume=False)
+
+        with DBSessionManager(engine) as current_session:
+            file_names = current_session.scalars(select(models.Assets.file_name)).all()
+
+        self.assertEqual(['linked.jpg'], file_names)
+        self.assertEqual([], storage_backend.get_objects(''))
+
+    def test_pipeline_releases_consumed_uploads(self):
+        engine = self.create_engine('pending_uploads')
+        storage_backend = LocalStorageBackend(os.path.join(self.work_dir, 'storage_pending_uploads'))
+        processor = self.create_processor(engine, storage_backend, pipeline=True)
+
+        with mock.patch.object(processor, '_upload_batch', wraps=processor._upload_batch) as upload_batch:
+            processor.modify_db_data_for_entities(engine, None, None, resume=False)
+
+        pending_uploads = upload_batch.call_args.args[0]
+        self.assertTrue(storage_backend.get_objects(''))
+        self.assertEqual({}, pending_uploads)
+
+    def test_main_image_of_first_migration_is_uploaded_once(self):
+        image_path = self.corpus.image_paths[0]
+        engine = self.create_engine('first_migration', [{
+            'news_content_id': 1, 'title': 'News 1', 'text': f'<p><img src="{image_path}"></p>',
+            'view_data': {'image_intro': f'{SyntheticCorpusGenerator.SITE_URL}{image_path}'},
+        }])
+        storage_backend = LocalStorageBackend(os.path.join(self.work_dir, 'storage_first_migration'))
+        processor = self.create_processor(engine, storage_backend, pipeline=False)
+
+        with mock.patch.object(storage_backend, 'upload_file', wraps=storage_backend.upload_file) as upload_file, \
+                mock.patch.object(AssetsService, 'get_or_create_asset_id') as get_or_create_asset_id:
+            processor.process_db(resume=False)
+
+        with DBSessionManager(engine) as current_session:
+            news_content = current_session.get(models.NewsContent, 1)
+            asset_ids = current_session.scalars(select(models.NewsContentAssets.c.asset_id)).all()
+
+            self.assertEqual([news_content.main_asset_id], asset_ids)
+
+        upload_file.assert_called_once()
+        get_or_create_asset_id.assert_not_called()
+
+    def run_migration(self, pipeline):
+        engine = self.create_engine(f'pipeline_{pipeline}')
+        storage_backend = LocalStorageBackend(os.path.join(self.work_dir, f'storage_{pipeline}'))
+        self.create_processor(engine, storage_backend, pipeline).process_db(resume=False)
+
+        with DBSessionManager(engine) as current_session:
+            news_content_texts = current_session.execute(select(
+                models.NewsContent.news_content_id, models.NewsContent.text).order_by(
+                models.NewsContent.news_content_id)).all()
+            news_content_file_names = current_session.execute(select(
+                models.NewsContentAssets.c.news_content_id, models.Assets.file_name).join(
+                models.Assets, models.Assets.asset_id == models.NewsContentAssets.c.asset_id)).all()
+            progress = MigrationProgressService(current_session).get_progress(self.processor.MODIFY_STAGE)
+
+            self.assertEqual((3, 12, True), (progress.batches_count, progress.rows_count, progress.is_finished))
+
+        self.assertTrue(news_content_file_names)
+        return [tuple(row) for row in news_content_texts], sorted(tuple(row) for row in news_content_file_names)
+
+    def create_engine(self, name, news_contents=None):
+        # a DB file: the pipeline stages work in different threads, every one with its own connection
+        engine = create_engine(f'sqlite:///{os.path.join(self.work_dir, f"{name}.sqlite3")}')
+        self.addCleanup(engine.dispose)
+        mapper_registry.metadata.create_all(engine)
+
+        with DBSessionManager(engine) as current_session:
+            current_session.execute(insert(models.NewsContent),
+                                    news_contents or list(self.corpus.generate_news_contents()))
+
+        return engine
+
+    def create_processor(self, engine, storage_backend, pipeline):
+        # the image paths of the corpus are relative to the work dir
+        file_uploader = FileUploader(file_upload_processor=FileUploadProcessor(storage_backend),
+                                     image_index=LocalImageIndex(self.work_dir).scan())
+        return self.processor(engine, batch_size=5, assets_index=AssetsIndex(snapshot_path=None), parse_workers=0,
+                              upload_workers=2, file_uploader=file_uploader, pipeline=pipeline)
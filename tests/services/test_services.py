@@ -1,6 +1,26 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
 import unittest
+from io import BytesIO
+from unittest import mock
 
-from services.parsers import ParseTextFromHtmlService, ParseAbsoluteToDomesticUrlService
+from boto3.s3.transfer import TransferConfig
+from sqlalchemy import create_engine, text
+
+from services.file_uploader import FileUploadPool, FileUploader, FileUploadProcessor, S3StorageBackend, \
+    LocalStorageBackend, get_shared_upload_manifest
+from benchmarks.corpus import SyntheticCorpusGenerator
+from services.parsers import ParseTextFromHtmlService, ParseAbsoluteToDomesticUrlService, ParallelParseService, \
+    SoupHtmlExtractor, StreamingHtmlExtractor
+from services.image_index import LocalImageIndex
+from services.image_optimizer import ImageOptimizer, ImageOptimizationOptions, Image
+from services.metrics import LatencyHistogram, MigrationMetrics, MetricsReporter
+from services.parse_cache import ParseResultCache
+from services.pipeline import StagedPipeline
+from services.upload_manifest import UploadManifest, get_file_content_hash
 from tests.services import mocks
 from tests.services.mocks import TEST_PARSE_ABSOLUTE_TO_DOMESTIC_URL_SERVICE
 
@@ -59,6 +79,87 @@ of_the_Republic_of_Belarus_took_part_in_the_Open_Tournament/photo_2023-03-26_21-
 
         self.assertEqual(image_urls, self.TEST_PARSED_YOUTUBE_URL_LIST)
 
+    def test_parse_result(self):
+        parse_result = self.parser.parse_result
+
+        self.assertEqual(parse_result.image_urls, self.TEST_PARSED_URL_LIST)
+        self.assertEqual(parse_result.link_urls, ['https://youtu.be/IeODSXm4s_E'] + self.TEST_PARSED_URL_LIST +
+                         ['index.php/321'])
+        self.assertEqual(parse_result.youtube_urls, self.TEST_PARSED_YOUTUBE_URL_LIST)
+        self.assertEqual(parse_result.youtube_codes, ['IeODSXm4s_EWd'])
+        self.assertEqual(self.parser.parse_text(), self.TEST_PARSED_TEXT)
+
+
+class TestStreamingHtmlParseTextFromHtmlService(TestParseTextFromHtmlService):
+
+    def setUp(self):
+        self.parser = self.service(mocks.TEST_PARSE_TEXT_FROM_HTML_SERVICE['Text'], extractor_backend='streaming')
+
+
+class TestHtmlExtractorsConformance(unittest.TestCase):
+    reference_extractor = SoupHtmlExtractor
+    extractor = StreamingHtmlExtractor
+    TEST_HTMLS = [
+        mocks.TEST_PARSE_TEXT_FROM_HTML_SERVICE['Text'],
+        mocks.TEST_NEWS_CONTENT_ENTITY['text'],
+        '<p>a &amp; b&nbsp;c &#147;q&#x201C; AT&T &unknown;</p><script>var p = "<p>no</p>";</script>'
+        '<style>p {}</style><!-- comment -->d<template><p>t</p></template>e<ruby>x<rt>y</rt></ruby>',
+        '<!DOCTYPE html><p>x<![CDATA[ cdata ]]>y</p><img src><a href>z</a><img href="h.jpg"><a>no href</a>',
+        '<p>unclosed <b>bold',
+        '<ruby>x<rt>y</ruby>z after',
+        '<div><template>t</div>rest of article',
+        '<p><rt>a<b>b</p>c</b>d</rt>e<br></br>f<div/>g<rp><img src="i.jpg"/>h</p>i</rp>j',
+        '',
+    ]
+
+    def test_extract(self):
+        corpus_htmls = [news_content['text'] for news_content in SyntheticCorpusGenerator(20).generate_news_contents()]
+
+        for html in self.TEST_HTMLS + corpus_htmls:
+            with self.subTest(html=html[:50]):
+                self.assertEqual(self.reference_extractor().extract(html), self.extractor().extract(html))
+
+
+class TestParseResultCache(unittest.TestCase):
+    cache = ParseResultCache
+    HTML = mocks.TEST_PARSE_TEXT_FROM_HTML_SERVICE['Text']
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_path = os.path.join(cache_dir.name, 'parse_cache.sqlite3')
+
+    def test_memory_cache_eviction(self):
+        parse_cache = self.cache(memory_size=2)
+
+        for key in ('a', 'b', 'c'):
+            parse_cache.set(key, [key])
+
+        self.assertIsNone(parse_cache.get('a'))
+        self.assertEqual(['c'], parse_cache.get('c'))
+        self.assertEqual((1, 1), (parse_cache.hits, parse_cache.misses))
+
+    def test_parse_result_is_reused_from_disk(self):
+        parse_cache = self.cache(self.cache_path)
+        parse_result = ParseTextFromHtmlService(self.HTML, parse_cache=parse_cache).parse_result
+        parse_cache.close()
+
+        parse_cache = self.cache(self.cache_path, memory_size=0)
+        self.addCleanup(parse_cache.close)
+        parse_service = ParseTextFromHtmlService(self.HTML, parse_cache=parse_cache)
+
+        with mock.patch.object(parse_service.extractor, 'extract') as extract_mock:
+            self.assertEqual(parse_result, parse_service.parse_result)
+            self.assertEqual(TestParseTextFromHtmlService.TEST_PARSED_TEXT, parse_service.parse_text())
+
+        extract_mock.assert_not_called()
+        self.assertEqual(1, parse_cache.hits)
+
+    def test_parser_version_and_backend_are_part_of_key(self):
+        self.assertNotEqual(self.cache.get_key(self.HTML, 1, 'soup'), self.cache.get_key(self.HTML, 2, 'soup'))
+        self.assertNotEqual(self.cache.get_key(self.HTML, 1, 'soup'), self.cache.get_key(self.HTML, 1, 'streaming'))
+        self.assertEqual(self.cache.get_key(self.HTML, 1, 'soup'), self.cache.get_key(self.HTML, 1, 'soup'))
+
 
 class TestParseAbsoluteToDomesticUrlService(unittest.TestCase):
     service = ParseAbsoluteToDomesticUrlService
@@ -71,3 +172,368 @@ class TestParseAbsoluteToDomesticUrlService(unittest.TestCase):
     def test_parse_url(self):
         parsed_urls = [self.service().parse_url(url) for url in TEST_PARSE_ABSOLUTE_TO_DOMESTIC_URL_SERVICE]
         self.assertListEqual(parsed_urls, self.TEST_PARSED_ABSOLUTE_TO_DOMESTIC_URL_SERVICE)
+
+
+class TestParallelParseService(unittest.TestCase):
+    service = ParallelParseService
+    NEWS_CONTENT_IDS = [321, 322, 323]
+
+    def setUp(self):
+        self.items = [(news_content_id, mocks.TEST_PARSE_TEXT_FROM_HTML_SERVICE['Text'])
+                      for news_content_id in self.NEWS_CONTENT_IDS]
+
+    def test_parse(self):
+        with self.service(max_workers=0) as parse_service:
+            parsed_htmls = parse_service.parse(self.items)
+
+        with self.service(max_workers=2) as parse_service:
+            parallel_parsed_htmls = parse_service.parse(self.items)
+
+        parsed_html = parsed_htmls[322]
+        self.assertEqual(parsed_htmls, parallel_parsed_htmls)
+        self.assertEqual(parsed_html.text, TestParseTextFromHtmlService.TEST_PARSED_TEXT)
+        self.assertEqual(parsed_html.image_urls, TestParseTextFromHtmlService.TEST_PARSED_URL_LIST)
+        self.assertEqual(parsed_html.youtube_urls, TestParseTextFromHtmlService.TEST_PARSED_YOUTUBE_URL_LIST)
+
+    def test_get_chunksize(self):
+        parse_service = self.service(max_workers=16, chunksize=0)
+
+        self.assertEqual(1, parse_service.get_chunksize(25))
+        self.assertEqual(7, parse_service.get_chunksize(500))
+        self.assertEqual(4, self.service(max_workers=16, chunksize=4).get_chunksize(500))
+
+
+class TestFileUploadPool(unittest.TestCase):
+    pool = FileUploadPool
+    FILE_PATHS = [
+        'tests/processor/test_pictures/test_picture_1.jpg',
+        'tests/processor/test_pictures/test_picture_2.png',
+        'tests/processor/test_pictures/missing_picture.png',
+    ]
+
+    def setUp(self):
+        self.upload_file_mock = mock.patch('services.file_uploader.FileUploader.upload_file').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_submit_file_from_path(self):
+        for max_workers in (0, 2):
+            with self.subTest(max_workers=max_workers), self.pool(max_workers=max_workers, max_pending=1) as pool:
+                futures = [pool.submit_file_from_path(file_path) for file_path in self.FILE_PATHS]
+
+                self.assertEqual(['test_picture_1.jpg', 'test_picture_2.png', ''],
+                                 [future.result() for future in futures])
+
+        self.assertEqual(4, self.upload_file_mock.call_count)
+
+
+class TestUploadManifest(unittest.TestCase):
+    manifest = UploadManifest
+    FILE_PATH = 'tests/processor/test_pictures/test_picture_1.jpg'
+
+    def setUp(self):
+        self.upload_file_mock = mock.patch('services.file_uploader.FileUploader.upload_file').start()
+        self.addCleanup(mock.patch.stopall)
+
+        manifest_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(manifest_dir.cleanup)
+        self.duplicated_file_path = shutil.copy(self.FILE_PATH, os.path.join(manifest_dir.name, 'duplicate.jpg'))
+
+        self.upload_manifest = self.manifest(os.path.join(manifest_dir.name, 'manifest.sqlite3'))
+        self.addCleanup(self.upload_manifest.close)
+
+    def test_upload_file_from_path_skips_uploaded_content(self):
+        file_uploader = FileUploader(upload_manifest=self.upload_manifest)
+
+        file_names = [file_uploader.upload_file_from_path(file_path)
+                      for file_path in (self.FILE_PATH, self.duplicated_file_path, self.FILE_PATH)]
+
+        self.assertEqual(['test_picture_1.jpg'] * 3, file_names)
+        self.assertEqual(1, self.upload_file_mock.call_count)
+        self.assertEqual('test_picture_1.jpg', self.upload_manifest.get_key(get_file_content_hash(self.FILE_PATH)))
+
+    def test_seed_from_storage(self):
+        storage_backend = mock.Mock()
+        storage_backend.get_objects_etags.return_value = {
+            'test_picture_1.jpg': get_file_content_hash(self.FILE_PATH),
+            'video.mp4': 'd41d8cd98f00b204e9800998ecf8427e-3',
+        }
+
+        self.upload_manifest.seed_from_storage(storage_backend)
+
+        self.assertEqual(1, len(self.upload_manifest))
+        self.assertEqual('test_picture_1.jpg', FileUploader(self.upload_manifest).upload_file_from_path(
+            self.duplicated_file_path))
+        self.upload_file_mock.assert_not_called()
+
+    def test_shared_manifest_is_opened_once_per_process(self):
+        manifest_path = self.upload_manifest.path
+        with mock.patch('settings.UPLOAD_MANIFEST_PATH', manifest_path), \
+                mock.patch('services.file_uploader._shared_upload_manifest', None):
+            upload_manifest = get_shared_upload_manifest()
+            self.addCleanup(upload_manifest.close)
+            self.assertIs(upload_manifest, get_shared_upload_manifest())
+
+            with mock.patch('os.getpid', return_value=os.getpid() + 1):
+                forked_upload_manifest = get_shared_upload_manifest()
+            self.addCleanup(forked_upload_manifest.close)
+
+        self.assertIsNot(upload_manifest, forked_upload_manifest)
+
+
+class TestS3StorageBackend(unittest.TestCase):
+    backend = S3StorageBackend
+    FILE_PATH = 'tests/processor/test_pictures/test_picture_1.jpg'
+
+    def setUp(self):
+        self.s3_client = mock.Mock()
+
+    def test_upload_file(self):
+        transfer_config = TransferConfig(multipart_threshold=100 * 1024)
+
+        with open(self.FILE_PATH, 'rb') as fileobj:
+            FileUploadProcessor(self.backend(self.s3_client, 'bucket', transfer_config)).upload_file(
+                'test_picture_1.jpg', fileobj)
+
+        self.s3_client.put_object.assert_called_once_with('bucket', 'test_picture_1.jpg', mock.ANY,
+                                                          ContentType='image/jpeg')
+        self.s3_client.upload_fileobj.assert_not_called()
+
+    def test_upload_file_with_multipart_upload(self):
+        transfer_config = TransferConfig(multipart_threshold=64 * 1024)
+
+        with open(self.FILE_PATH, 'rb') as fileobj:
+            FileUploadProcessor(self.backend(self.s3_client, 'bucket', transfer_config)).upload_file(
+                'test_picture_1.jpg', fileobj)
+
+        self.s3_client.upload_fileobj.assert_called_once_with('bucket', 'test_picture_1.jpg', mock.ANY,
+                                                              transfer_config, ContentType='image/jpeg')
+        self.s3_client.put_object.assert_not_called()
+
+
+class TestLocalStorageBackend(unittest.TestCase):
+    backend = LocalStorageBackend
+    FILE_PATH = 'tests/processor/test_pictures/test_picture_1.jpg'
+    KEY = 'images/test_picture_1.jpg'
+
+    def setUp(self):
+        storage_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(storage_dir.cleanup)
+        self.storage_backend = self.backend(storage_dir.name, latency=0, bandwidth=None)
+        self.file_upload_processor = FileUploadProcessor(self.storage_backend)
+
+    def test_upload_file(self):
+        with open(self.FILE_PATH, 'rb') as fileobj:
+            response = self.file_upload_processor.upload_file(self.KEY, fileobj)
+
+        self.assert_object_is_stored(response)
+
+    def test_upload_file_async(self):
+        with open(self.FILE_PATH, 'rb') as fileobj:
+            response = asyncio.run(self.file_upload_processor.upload_file_async(self.KEY, fileobj))
+
+        self.assert_object_is_stored(response)
+
+    def test_concurrent_uploads_of_same_key(self):
+        storage_backend = self.backend(self.storage_backend.root_path, latency=0, bandwidth=10 ** 6)
+        storage_backend.CHUNK_SIZE = 1024
+        contents = [bytes([index]) * 4 * storage_backend.CHUNK_SIZE for index in range(2)]
+
+        async def upload_concurrently():
+            await asyncio.gather(*(storage_backend.upload_file_async(self.KEY, BytesIO(content))
+                                   for content in contents))
+
+        asyncio.run(upload_concurrently())
+
+        with open(storage_backend.get_object_path(self.KEY), 'rb') as object_file:
+            self.assertIn(object_file.read(), contents)
+        self.assertEqual(['test_picture_1.jpg'], os.listdir(os.path.join(storage_backend.root_path, 'images')))
+
+    def assert_object_is_stored(self, response):
+        content_hash = get_file_content_hash(self.FILE_PATH)
+
+        self.assertEqual({'ETag': f'"{content_hash}"'}, response)
+        self.assertEqual({self.KEY: content_hash}, self.storage_backend.get_objects_etags('images/'))
+        self.assertEqual([], self.storage_backend.get_objects('video/'))
+        self.assertEqual({'ContentType': 'image/jpeg'}, self.storage_backend.objects_metadata[self.KEY])
+
+
+class TestMigrationMetrics(unittest.TestCase):
+    metrics = MigrationMetrics
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram()
+        for milliseconds in range(1, 101):
+            histogram.observe(milliseconds / 1000)
+
+        self.assertEqual(100, histogram.count)
+        self.assertAlmostEqual(0.05, histogram.get_percentile(50), delta=0.05 * (histogram.GROWTH - 1))
+        self.assertAlmostEqual(0.099, histogram.get_percentile(99), delta=0.099 * (histogram.GROWTH - 1))
+        self.assertEqual(0.1, histogram.get_percentile(100))
+
+    def test_sql_queries_are_counted(self):
+        engine = create_engine('sqlite://')
+        self.addCleanup(engine.dispose)
+        metrics = self.metrics()
+        metrics.instrument_engine(engine)
+        metrics.instrument_engine(engine)
+
+        with engine.connect() as connection:
+            for _ in range(3):
+                connection.execute(text('SELECT 1'))
+        metrics.increment(self.metrics.NEWS_CONTENTS_COUNTER, 2)
+
+        summary = metrics.summary()
+        self.assertEqual(3, summary['counters']['queries'])
+        self.assertEqual(3, summary['stages']['sql']['count'])
+        self.assertEqual(1.5, summary['queries_per_news_content'])
+
+    def test_reporter_writes_json_lines(self):
+        metrics_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(metrics_dir.cleanup)
+        metrics_path = os.path.join(metrics_dir.name, 'metrics.jsonl')
+        metrics = self.metrics()
+
+        with MetricsReporter(metrics, interval=0, path=metrics_path):
+            with metrics.measure('parse'):
+                pass
+            self.assertEqual([1, 2], list(metrics.measure_iter('upload', [1, 2])))
+
+        with open(metrics_path, encoding='utf-8') as metrics_file:
+            summaries = [json.loads(line) for line in metrics_file]
+
+        self.assertEqual(1, len(summaries))
+        self.assertEqual(1, summaries[0]['stages']['parse']['count'])
+        self.assertEqual(3, summaries[0]['stages']['upload']['count'])
+
+
+class TestStagedPipeline(unittest.TestCase):
+    pipeline = StagedPipeline
+
+    def test_run(self):
+        pipeline = self.pipeline([('double', lambda item: item * 2), ('increment', lambda item: item + 1)],
+                                 queue_size=1)
+
+        self.assertEqual([item * 2 + 1 for item in range(20)], list(pipeline.run(range(20))))
+
+    def test_stage_error_is_raised(self):
+        def fail_on_three(item):
+            if item == 3:
+                raise ValueError(item)
+            return item
+
+        pipeline = self.pipeline([('fail', fail_on_three)], queue_size=1)
+        results = []
+
+        with self.assertRaises(ValueError):
+            for item in pipeline.run(range(10)):
+                results.append(item)
+
+        self.assertEqual([0, 1, 2], results)
+
+    def test_stopped_consumer_stops_stages(self):
+        pipeline = self.pipeline([('identity', lambda item: item)], queue_size=1)
+        results = pipeline.run(iter(range(1000)))
+
+        self.assertEqual(0, next(results))
+        results.close()
+
+
+class TestLocalImageIndex(unittest.TestCase):
+    index = LocalImageIndex
+    FILE_PATHS = ['images/novosti/Gallery 1/Photo 1.JPG', 'images/novosti/gallery_2/photo_2.png',
+                  'images/novosti/gallery_2/photo_3.png', 'images/novosti/gallery_3/photo_3.png']
+
+    def setUp(self):
+        root_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(root_dir.cleanup)
+        self.root_path = root_dir.name
+
+        for file_path in self.FILE_PATHS:
+            os.makedirs(os.path.join(self.root_path, os.path.dirname(file_path)), exist_ok=True)
+            with open(os.path.join(self.root_path, file_path), 'wb') as image_file:
+                image_file.write(b'image')
+
+    def test_resolve(self):
+        image_index = self.index(self.root_path, max_workers=2).scan()
+
+        self.assertEqual(len(self.FILE_PATHS), len(image_index))
+        file_info = image_index.resolve('images/novosti/gallery%201/photo%201.jpg')
+        self.assertEqual((self.FILE_PATHS[0], len(b'image')), (file_info.path, file_info.size))
+        self.assertEqual(self.FILE_PATHS[1], image_index.resolve('./images/novosti/photo_2.png').path)
+        self.assertEqual(os.path.join(self.root_path, *self.FILE_PATHS[1].split('/')),
+                         image_index.get_file_path('images/novosti/gallery_2/photo_2.png'))
+        self.assertEqual(['images/novosti/photo_3.png', 'images/novosti/missing.png'], image_index.find_unresolved([
+            'images/novosti/photo_3.png', 'images/novosti/gallery_3/photo_3.png', 'images/novosti/missing.png',
+            'images/novosti/missing.png']))
+
+    def test_file_uploader_uses_image_index(self):
+        image_index = self.index(self.root_path).scan()
+        file_upload_processor = mock.Mock()
+        file_uploader = FileUploader(file_upload_processor=file_upload_processor, image_index=image_index)
+
+        self.assertEqual('Photo 1.jpg', file_uploader.upload_file_from_path('images/novosti/GALLERY 1/Photo%201.jpg'))
+        self.assertEqual('', file_uploader.upload_file_from_path('images/novosti/missing.png'))
+        file_upload_processor.upload_file.assert_called_once()
+
+
+@unittest.skipUnless(Image, 'Pillow is not installed')
+class TestImageOptimizer(unittest.TestCase):
+    optimizer = ImageOptimizer
+
+    def setUp(self):
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+        self.work_dir = work_dir.name
+        self.cache_path = os.path.join(self.work_dir, 'image_cache')
+
+        self.image_path = os.path.join(self.work_dir, 'photo.jpg')
+        image = Image.linear_gradient('L').resize((1200, 800)).convert('RGB')
+        exif = Image.Exif()
+        exif[0x010f] = 'Camera'
+        image.save(self.image_path, 'JPEG', quality=100, exif=exif)
+
+    def test_optimize(self):
+        optimizer = self.optimizer(self.cache_path, ImageOptimizationOptions(max_dimension=300, quality=80),
+                                   max_workers=0)
+        optimized_image = optimizer.optimize(self.image_path)
+
+        with Image.open(optimized_image.file_path) as image:
+            self.assertEqual(('JPEG', (300, 200)), (image.format, image.size))
+            self.assertNotIn('exif', image.info)
+        self.assertLess(os.path.getsize(optimized_image.file_path), os.path.getsize(self.image_path))
+
+        with mock.patch('services.image_optimizer.optimize_image') as optimize_image_mock:
+            self.assertEqual(optimized_image, optimizer.optimize(self.image_path))
+        optimize_image_mock.assert_not_called()
+
+    def test_not_optimized_image_is_uploaded_as_it_is(self):
+        gif_path = os.path.join(self.work_dir, 'animation.gif')
+        Image.new('P', (10, 10)).save(gif_path, 'GIF')
+        optimizer = self.optimizer(self.cache_path, max_workers=0)
+
+        self.assertEqual(gif_path, optimizer.optimize(gif_path).file_path)
+        self.assertEqual(gif_path, optimizer.optimize(gif_path).file_path)
+
+    def test_file_uploader_uploads_webp(self):
+        optimizer = self.optimizer(self.cache_path, ImageOptimizationOptions(max_dimension=300, webp=True),
+                                   max_workers=0)
+        storage_backend = mock.Mock()
+        file_uploader = FileUploader(file_upload_processor=FileUploadProcessor(storage_backend),
+                                     image_optimizer=optimizer)
+
+        self.assertEqual('photo.jpg', file_uploader.upload_file_from_path(self.image_path))
+        key, fileobj = storage_backend.upload_file.call_args.args
+        self.assertEqual('photo.jpg', key)
+        self.assertEqual({'ContentType': 'image/webp'}, storage_backend.upload_file.call_args.kwargs)
+
+    def test_unreadable_image_is_not_optimized(self):
+        optimizer = self.optimizer(self.cache_path, max_workers=0)
+
+        def optimize_image(source_path, target_path, options):
+            open(target_path, 'wb').close()
+            raise Image.DecompressionBombError('Image size exceeds limit')
+
+        with mock.patch('services.image_optimizer.optimize_image', side_effect=optimize_image):
+            self.assertEqual(self.image_path, optimizer.optimize(self.image_path).file_path)
+        self.assertEqual([f'{get_file_content_hash(self.image_path)}_{optimizer.options.key}.original'],
+                         os.listdir(self.cache_path))
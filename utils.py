@@ -1,4 +1,5 @@
 from functools import wraps
+from itertools import islice
 
 
 def stored_property(method):
@@ -58,3 +59,17 @@ def stored_property(method):
         return getattr(self, attr)
 
     return property(wrapper)
+
+
+def chunked(iterable, size):
+    """
+    Splits the iterable into lists of 'size' items (the last list may be shorter).
+
+    Example:
+
+        >>> list(chunked(range(5), 2))
+        [[0, 1], [2, 3], [4]]
+    """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk